@@ -1,133 +1,139 @@
 #--------------------------------------------------------------------------------------------------
 # RAPID model discharge SWOT-orbit resampler
 #--------------------------------------------------------------------------------------------------
-# This python code takes three inputs: 
-#	1) the model outputs ("modeled_outputs.nc”), 
-# 	2) the map of the largest rivers that are computed (“largest_rivers.shp”), and 
-# 	3) the SWOT orbit map (“SWOT_orbit.shp”), 
+# This python code takes three inputs:
+#	1) the model outputs ("modeled_outputs.nc”),
+# 	2) the map of the largest rivers that are computed (“largest_rivers.shp”), and
+# 	3) the SWOT orbit map (“SWOT_orbit.shp”),
 #
-# The input data are currently hard-coded in main module at the bottom for ease of testing, 
-# but will be modified to parse command line arguments, once we get the script doing what it should.
+# It runs the overlay of rrr_swt_riv_orb_ovl.py and the sampling of rrr_swt_riv_orb_mod.py in a
+# single process: the overlays are handed over in memory as NumPy arrays instead of through the
+# intermediate CSV file. It can be imported by batch drivers, or run from the command line:
+#   ./rapid_q_swot_orbit_resampler.py modeled_outputs.nc largest_rivers.shp SWOT_orbit.shp sampled_outputs.csv
+# with the optional settings --workers, --cache, --tolerance, --cycle_length, --cycles, --format,
+# --estimators, --window, --report and --profile of the two scripts.
 #--------------------------------------------------------------------------------------------------
 
-# function extracting the rapid discharge data, from the spatial intersection of rivers by a submodule
-def rapid_q_swot_orbit_resampler (rapid_q, rivers, swot_orbits, resampled_output):
-
-	# import modules
-	import from netCDF4 import Dataset
-	import pandas as np
-	import fiona
-	from shapely.geometry import shape, mapping
-	import rtree
-
-
-	# before attempting to select individual rivers with the orbits, we could first subset the orbits based on their intersection with the bounding box of river reaches.
-	# this would exclude orbits that don't overlap at all with the river shapefile, and thus speed up the subsequent intersection for individual river reaches.
-	# It seems like the module 'pyshp' can easily do that:  bbox = shapes[3].bbox
-
-
-	# execute the intersection function (defined below) between the river reach and swot orbit identifiers
-	# returns a dataframe of the identifiers intersection 
-	intersected_rivers = shapefile_intersection(rivers, swot_orbits)
-
-	# read in the RAPID discharge NETcdf file as a pandas dataframe
-	rapid_q = Dataset(rapid_q, mode='r')
-	# print rapid_q.variables   
-	# print rapid_q.dimensions.keys()
-	qout_df = pd.DataFrame(rapid_q.variables['Qout'][:])
+import pandas as pd
+import rrr_swt_arg_lib
+import rrr_swt_ovl_lib
+import rrr_swt_mod_lib
+import rrr_swt_out_lib
+import rrr_swt_prf_lib
+
+
+# function extracting the rapid discharge data, from the spatial intersection of rivers and orbits.
+# If resampled_output is given, the sampled discharge is written there block by block as it is
+# computed, as csv, netcdf or parquet (from its extension unless output_format is given);
+# otherwise it is returned as a single dataframe.
+# The estimators ('linear', 'mean', 'min', 'max') are added as columns Qout_<estimator> next to
+# the discharge at the closest time step, the last three over the time steps within window seconds
+# of each pass (one model time step by default).
+def rapid_q_swot_orbit_resampler (rapid_q, rivers, swot_orbits, resampled_output=None,
+                                  workers=1, cache=None, tolerance=None, cycle_length=1802700,
+                                  cycles=None, output_format=None, estimators=None, window=None):
+
+	# check the estimators before the intersection rather than after it
+	rrr_swt_mod_lib.est_chk(estimators or [])
+
+	# execute the intersection between the river reaches and swot orbits.
+	# returns the unique reach IDs, the offsets of their orbit times and the orbit times of the
+	# intersection, in compressed sparse row format, which the sampling takes as such
+	IV_ovl_id, IV_ovl_off, ZV_ovl_tim = shapefile_intersection(rivers, swot_orbits, workers, cache,
+	                                                           csr=True)
 
 	# NOTE: I initally wondered how to deal with river reaches straddling across the edge of the orbit;
-	# upon further thought I realized that we'll need to use reach_id later on, so splitting reaches into new ones wouldn't be helpful there.  
-	# join the intersection table to the rapid table, keeping only matches on 'REACHCODE' and 'Mean Time' of orbit 
-	# (or within a time-window of orbit if there is an exact time mathc is not possible)
+	# upon further thought I realized that we'll need to use reach_id later on, so splitting reaches into new ones wouldn't be helpful there.
+	# Only reaches completely contained in an orbit are kept, and each pass is matched to the
+	# closest time step of the RAPID discharge (within a tolerance if one is given)
 
 	# Cedric - We noticed that COMID's weren't all unique in the river shapefile. How should we deal with that?
 	# Apoorva - I think you had a script from the workshop that did this - and matched time periods (have both start at Jan 1st)
-	resampled_output = intersected_rivers.merge(rapid_q, left_on=['COMID','Mean time'], right_on=['COMID','Time'], how='inner')
-	# this join would only work if the rapid_q data would have long format
-
-	# write the output dataframe to a netcdf file as defined in argurment
-
-	# also return the output dataframe, for function to be used as sub-module of broader script.
+	# The overlays are grouped by COMID, so a COMID split over several features is sampled once per orbit pass
+	resampled_blocks = rrr_swt_mod_lib.ovl_smp(rapid_q, IV_ovl_id, ZV_ovl_tim, ZS_cyc=cycle_length,
+	                                           IS_cyc=cycles, ZS_tol=tolerance, YV_est=estimators,
+	                                           ZS_est_win=window, IV_ovl_off=IV_ovl_off)
+
+	# return the output dataframe, for function to be used as sub-module of broader script.
+	if resampled_output is None:
+		return pd.concat(list(resampled_blocks))
+
+	# or write the output dataframe to the file defined in argument
+	output_format = rrr_swt_out_lib.out_fmt(resampled_output, output_format)
+	first_block = True
+	for resampled_df in resampled_blocks:
+		with rrr_swt_prf_lib.prf_stg('write_output'):
+			rrr_swt_out_lib.out_write(resampled_output, output_format, resampled_df, first_block)
+		rrr_swt_prf_lib.prf_cnt('write_output', 'rows', len(resampled_df))
+		first_block = False
 	return resampled_output
 
 
 #-------------------------------------------------------------------------------------
-# function intersecting two shapefiles, while keeping IDs of feat1.
-# modified from the webpage suggested by Cedric on May 5 2016:  http://gis.stackexchange.com/questions/119374/intersect-shapefiles-using-shapely
-# Shapely (does the intersection), and Rtree (allows to make the process of intersection faster).
-# We only need a table of the intersection reaches and orbits (in long-table format).
-# There is no need do not need a shapefile output
-
-def shapefile_intersection (in_swot, in_riv, out_intersect):
-	
-	# create empty dataframe for the output
-	output_df = pd.DataFrame(columns=['COMID','TIME', 'ORBITID','QOUT'])
-
-	with fiona.open(in_swot, 'r') as layer1:
-
-	    with fiona.open(in_riv, 'r') as layer2:
-	        
-	        # We copy schema and add the  new property for the new resulting shp
-	        schema = layer2.schema.copy()
-	        schema['properties']['COMID']['FID']['Mean time'] = 'int:10'   
-
-	        # We open a first empty shp to write new content from both others shp
-	        with fiona.open(out_intersect, 'w', 'ESRI Shapefile', schema) as layer3:
-	            index = rtree.index.Index()
-	            
-	            for feat1 in layer1:
-	                fid = int(feat1['FID'])
-	                time = int(feat1['Mean time'])
-	                geom1 = shape(feat1['geometry'])
-	                index.insert(fid, geom1.bounds)
-
-	            for feat2 in layer2:
-	                reachcode = int(feat2['REACHCODE'])
-	                geom2 = shape(feat2['geometry'])
-	                for fid in list(index.intersection(geom2.bounds)):
-	                    if fid != int(feat2['id']):
-	                        feat1 = layer1[fid]
-	                        geom1 = shape(feat1['geometry'])
-	                        if geom1.intersects(geom2):
-	                            
-	                            # We take attributes from shp2, as a data frame
-	                            out_df = pd.DataFrame(feat2['properties'])
-	                            # Then append the uid attribute we want from the other shp
-	                            #props['fid'] = feat1['properties']['fid']
-	                            
-	                            # append the loop intersect output to the cumulative 'intersect_df'
-	                            intersect_df = output_df.append(out_row, ignore_index=True) 
-
-    # return a pandas dataframe of the intersecting data
-    return intersect_df
-
-
-# test the function above with subset test data 
+# function intersecting the river and SWOT orbit shapefiles, keeping the river reach IDs
+# and the 'Mean_time' of the orbit passes for every river reach completely inside an orbit.
+# Shapely does the intersection, with a bulk-loaded STRtree to make it faster: orbits outside the
+# river network are skipped, and each swath is cut into compact segments before the tree query.
+# We only need a table of the intersection reaches and orbit times (in long-table format),
+# returned as two arrays sorted by river reach ID and then by orbit, each reach ID being
+# counted once per orbit even if it is split over several river features.
+# With csr=True, the reach IDs are instead listed once each, with the offsets of their orbit
+# times (compressed sparse row format of rrr_swt_ovl_lib.ovl_csr()).
+# There is no need for a shapefile output
+
+def shapefile_intersection (in_riv, in_swot, workers=1, cache=None, csr=False):
+
+	with rrr_swt_prf_lib.prf_stg('read_rivers'):
+		if cache is not None and cache != '':
+			riv_id_name, riv_id, riv_geo = rrr_swt_ovl_lib.riv_shp_read_cch(in_riv, cache)
+		else:
+			riv_id_name, riv_id, riv_geo = rrr_swt_ovl_lib.riv_shp_read(in_riv)
+	rrr_swt_prf_lib.prf_cnt('read_rivers', 'rows', len(riv_id))
+	with rrr_swt_prf_lib.prf_stg('read_orbits'):
+		orb_time, orb_geo = rrr_swt_ovl_lib.orb_shp_read(in_swot)
+	rrr_swt_prf_lib.prf_cnt('read_orbits', 'rows', len(orb_time))
+
+	with rrr_swt_prf_lib.prf_stg('overlay'):
+		ovl_orb, ovl_riv, cnd_cnt, tst_cnt = rrr_swt_ovl_lib.ovl_riv_orb_par(riv_geo, orb_geo, workers)
+	rrr_swt_prf_lib.prf_cnt('overlay', 'rows', len(orb_time))
+	rrr_swt_prf_lib.prf_cnt('overlay', 'containments', len(ovl_riv))
+	rrr_swt_prf_lib.prf_cnt('overlay', 'candidates', int(cnd_cnt.sum()))
+	rrr_swt_prf_lib.prf_cnt('overlay', 'exact_tests', int(tst_cnt.sum()))
+	csr_id, csr_off, csr_time, csr_orb = rrr_swt_ovl_lib.ovl_csr(riv_id, ovl_riv, ovl_orb, orb_time)
+
+	# return the reach IDs and orbit times of the intersecting data
+	if csr:
+		return csr_id, csr_off, csr_time
+	return rrr_swt_ovl_lib.csr_flat(csr_id, csr_off, csr_time)
+
+
+# run the resampler from the command line
 if __name__ == '__main__':
 
-	import sys
-
-	# reads in command line arguments
-	cmdargs = str(sys.argv)
-
-	# hardcoding the input file pathes, for ease of testing.
-	rapid_q_output = r'Qout_San_Guad_1460days_p3_dtR900s.nc'
-	rivers = r'..\data\nhd\NHDFlowline_San_Guad_with_dir.shp'
-	swot_orbit = r'..\data\swot_swaths\SWOT_890km_77_onepolypertrack_nadirgap_180.shp'
-	resampled_output = r'..\output\test.csv'
-
-	# the below code parses command line arguments as inputs, we can use it once we get the script doing what it should.
-	"""
 	# declare input and output files from the command line arguments
-	# this would be have the following format:
-	#   ./rapid_q_swot_orbit_resampler.py modeled_outputs.nc largest_rivers.shp SWOT_orbit.shp sampled_outputs.nc
-	
-	rapid_q_output = sys.argv[0]
-	rivers = sys.argv[1]
-	swot_orbit = sys.argv[2]
-	resampled_output = sys.argv[3]
-	"""
-
-	# execute the resampler function using the input files. 
-	rapid_q_swot_orbit_resampler(rapid_q_output, rivers, swot_orbit, resampled_output)
\ No newline at end of file
+	# this has the following format:
+	#   ./rapid_q_swot_orbit_resampler.py modeled_outputs.nc largest_rivers.shp SWOT_orbit.shp sampled_outputs.csv
+	args, opts = rrr_swt_arg_lib.arg_get(4, ['workers', 'cache', 'tolerance', 'cycle_length', 'cycles',
+	                                          'format', 'estimators', 'window', 'report', 'profile'])
+
+	rapid_q_output = args[0]
+	rivers = args[1]
+	swot_orbit = args[2]
+	resampled_output = args[3]
+
+	# record the stage timings if a report or profiles are requested
+	rrr_swt_prf_lib.prf_ini(opts.get('profile', ''))
+
+	# execute the resampler function using the input files.
+	rapid_q_swot_orbit_resampler(rapid_q_output, rivers, swot_orbit, resampled_output,
+	                             workers=rrr_swt_arg_lib.opt_int(opts, 'workers', 1),
+	                             cache=opts.get('cache'),
+	                             tolerance=rrr_swt_arg_lib.opt_float(opts, 'tolerance', None),
+	                             cycle_length=rrr_swt_arg_lib.opt_float(opts, 'cycle_length', 1802700),
+	                             cycles=rrr_swt_arg_lib.opt_int(opts, 'cycles', None),
+	                             output_format=opts.get('format'),
+	                             estimators=[x for x in opts.get('estimators', '').split(',') if x != ''],
+	                             window=rrr_swt_arg_lib.opt_float(opts, 'window', None))
+
+	if 'report' in opts or 'profile' in opts:
+		rrr_swt_prf_lib.prf_write(opts.get('report', ''))
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+#******************************************************************************
+#rrr_swt_arg_lib.py
+#******************************************************************************
+#Purpose:
+#Command line handling shared by the SWOT orbit scripts. Positional arguments
+#are the mandatory input and output files, optional settings are given as
+#'--name=value' anywhere on the command line.
+#Authors:
+#Cedric H. David, Etienne Fluet-Chouinard, 2016-2016
+
+
+#*******************************************************************************
+#Import Python modules
+#*******************************************************************************
+import sys
+
+
+#*******************************************************************************
+#Get command line arguments
+#*******************************************************************************
+#Splits the command line into positional arguments and options, checks that
+#exactly IS_arg_req positional arguments are given and that all options are
+#among YV_opt_all. Returns the list of positional arguments and a dictionary of
+#options, a flag given without '=value' being stored as an empty string.
+
+def arg_get(IS_arg_req, YV_opt_all):
+     YV_arg=[]
+     YM_opt={}
+     for YS_arg in sys.argv[1:]:
+          if YS_arg.startswith('--'):
+               YS_opt_nam,YS_opt_sep,YS_opt_val=YS_arg[2:].partition('=')
+               if YS_opt_nam not in YV_opt_all:
+                    print('ERROR - Unknown option: '+YS_arg)
+                    print('- Available options are: --'+', --'.join(YV_opt_all))
+                    raise SystemExit(22)
+               YM_opt[YS_opt_nam]=YS_opt_val
+          else:
+               YV_arg.append(YS_arg)
+
+     if len(YV_arg) != IS_arg_req:
+          print('ERROR - '+str(IS_arg_req)+' and only '+str(IS_arg_req)+       \
+                ' arguments can be used')
+          raise SystemExit(22)
+
+     return YV_arg, YM_opt
+
+
+#*******************************************************************************
+#Get an integer option
+#*******************************************************************************
+#Returns the integer value of option YS_opt_nam, or IS_opt_def if the option
+#was not given or was given without a value.
+
+def opt_int(YM_opt, YS_opt_nam, IS_opt_def):
+     if YS_opt_nam not in YM_opt or YM_opt[YS_opt_nam] == '':
+          return IS_opt_def
+     try:
+          return int(YM_opt[YS_opt_nam])
+     except ValueError:
+          print('ERROR - The option --'+YS_opt_nam+' must be an integer')
+          raise SystemExit(22)
+
+
+#*******************************************************************************
+#Get a real option
+#*******************************************************************************
+#Returns the real value of option YS_opt_nam, or ZS_opt_def if the option was
+#not given or was given without a value.
+
+def opt_float(YM_opt, YS_opt_nam, ZS_opt_def):
+     if YS_opt_nam not in YM_opt or YM_opt[YS_opt_nam] == '':
+          return ZS_opt_def
+     try:
+          return float(YM_opt[YS_opt_nam])
+     except ValueError:
+          print('ERROR - The option --'+YS_opt_nam+' must be a number')
+          raise SystemExit(22)
+
+
+#*******************************************************************************
+#End
+#*******************************************************************************
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+#******************************************************************************
+#rrr_swt_bch.py
+#******************************************************************************
+#Purpose:
+#Benchmark of the SWOT orbit overlay and sampling stages on synthetic data.
+#River networks (line shapefiles with COMID), SWOT swaths (polygon shapefiles
+#with Mean_time) and RAPID-style Qout files, both NetCDF-4 and classic
+#netCDF-3, are generated at the given sizes, each stage is timed, the peak
+#resident memory is recorded, and the results are compared with a stored
+#baseline if one is given. Everything runs offline, and the exit status is
+#non-zero if a stage is slower than the baseline by more than the allowed
+#factor or if its results differ.
+#Authors:
+#Cedric H. David, Etienne Fluet-Chouinard, 2016-2016
+
+
+#*******************************************************************************
+#Import Python modules
+#*******************************************************************************
+import os
+import json
+import time
+import resource
+import hashlib
+import multiprocessing
+import fiona
+import netCDF4
+import numpy as np
+import shapely.geometry
+import rrr_swt_arg_lib
+import rrr_swt_ovl_lib
+import rrr_swt_mod_lib
+
+
+#*******************************************************************************
+#Declaration of variables (given as command line arguments)
+#*******************************************************************************
+# 1 - rrr_bch_dir
+# 2 - rrr_bch_json
+#Options:
+# --sizes=IS_riv_tot,... - numbers of river reaches (default: 1000,10000)
+# --orbits=IS_orb_tot - number of orbit passes (default: 100)
+# --steps=IS_tim_tot - number of 3-hourly model time steps (default: 2920)
+# --workers=IS_wrk - number of processes used for the overlay (default: 1)
+# --baseline=rrr_bch_old - results of a previous run to compare with
+# --slowdown=ZS_slo - allowed ratio of stage time to baseline (default: 1.5)
+
+
+#*******************************************************************************
+#Generate a synthetic river network
+#*******************************************************************************
+#Short reaches of two to four vertices scattered over a square domain whose
+#size grows with the number of reaches, so that the density stays constant.
+
+def bch_riv(rrr_riv_shp, IS_riv_tot, ZS_dom):
+     ZV_rng=np.random.RandomState(IS_riv_tot)
+     rrr_riv_sch={'geometry': 'LineString', 'properties': {'COMID': 'int:9'}}
+     with fiona.open(rrr_riv_shp, 'w', driver='ESRI Shapefile',               \
+                     schema=rrr_riv_sch, crs='EPSG:4326') as rrr_riv_lay:
+          for JS_riv_tot in range(IS_riv_tot):
+               ZV_xy0=ZV_rng.uniform(0, ZS_dom, 2)
+               IS_vtx=ZV_rng.randint(2, 5)
+               ZM_xy=ZV_xy0+np.cumsum(ZV_rng.uniform(-0.02, 0.02, (IS_vtx, 2)),\
+                                      axis=0)
+               rrr_riv_lay.write({                                             \
+                    'geometry': shapely.geometry.mapping(                      \
+                                shapely.geometry.LineString(ZM_xy)),           \
+                    'properties': {'COMID': JS_riv_tot+1}})
+
+
+#*******************************************************************************
+#Generate synthetic SWOT swaths
+#*******************************************************************************
+#Long diagonal swaths crossing the domain, alternately ascending and
+#descending, with a Mean_time spread over one 1802700 s repeat cycle.
+
+def bch_orb(rrr_orb_shp, IS_orb_tot, ZS_dom):
+     rrr_orb_sch={'geometry': 'Polygon', 'properties': {'Mean_time': 'float'}}
+     with fiona.open(rrr_orb_shp, 'w', driver='ESRI Shapefile',               \
+                     schema=rrr_orb_sch, crs='EPSG:4326') as rrr_orb_lay:
+          for JS_orb_tot in range(IS_orb_tot):
+               ZS_x00=(JS_orb_tot*ZS_dom*2.0)/IS_orb_tot-ZS_dom*0.5
+               ZS_dxy=ZS_dom*0.5 if JS_orb_tot % 2 == 0 else -ZS_dom*0.5
+               ZS_wid=max(ZS_dom/IS_orb_tot, 0.1)
+               orb_shy=shapely.geometry.Polygon([(ZS_x00, 0),                  \
+                                                 (ZS_x00+ZS_wid, 0),           \
+                                                 (ZS_x00+ZS_wid+ZS_dxy, ZS_dom),\
+                                                 (ZS_x00+ZS_dxy, ZS_dom)])
+               rrr_orb_lay.write({                                             \
+                    'geometry': shapely.geometry.mapping(orb_shy),             \
+                    'properties': {'Mean_time':                                \
+                                   1802700.0*JS_orb_tot/IS_orb_tot}})
+
+
+#*******************************************************************************
+#Generate a synthetic RAPID Qout file
+#*******************************************************************************
+#Qout(Time, COMID) in float32, chunked along both dimensions as RAPID does, with
+#values that depend on the reach and time step so that sampling errors show.
+#With YS_nc_fmt='NETCDF3_CLASSIC', the same values are written unchunked as in
+#the classic RAPID outputs.
+
+def bch_qou(rrr_mod_nc, IS_riv_tot, IS_tim_tot, YS_nc_fmt='NETCDF4'):
+     if YS_nc_fmt == 'NETCDF4':
+          YM_qou_opt={'zlib': True, 'chunksizes': (min(IS_tim_tot, 256),       \
+                                                   min(IS_riv_tot, 1024))}
+     else:
+          YM_qou_opt={}
+     with netCDF4.Dataset(rrr_mod_nc, 'w', format=YS_nc_fmt) as rrr_mod_dat:
+          rrr_mod_dat.createDimension('Time', IS_tim_tot)
+          rrr_mod_dat.createDimension('COMID', IS_riv_tot)
+          rrr_mod_dat.createVariable('Time', 'i4', ('Time',))[:]=              \
+                                                        np.arange(IS_tim_tot)
+          rrr_mod_dat.createVariable('COMID', 'i4', ('COMID',))[:]=            \
+                                                   np.arange(1, IS_riv_tot+1)
+          rrr_qou_var=rrr_mod_dat.createVariable('Qout', 'f4',                \
+                      ('Time', 'COMID'), **YM_qou_opt)
+          ZV_riv=np.arange(1, IS_riv_tot+1, dtype=np.float32)
+          for JS_tim_beg in range(0, IS_tim_tot, 256):
+               IS_tim_end=min(JS_tim_beg+256, IS_tim_tot)
+               ZV_tim=np.arange(JS_tim_beg, IS_tim_end, dtype=np.float32)
+               rrr_qou_var[JS_tim_beg:IS_tim_end, :]=                          \
+                         ZV_riv[None, :]+np.sin(ZV_tim[:, None]*0.01)
+
+
+#*******************************************************************************
+#Run all stages for one size
+#*******************************************************************************
+#Runs in its own process so that the peak resident memory of each size is not
+#inflated by the previous sizes. Stages are run in order and the peak resident
+#memory is read after each of them, so it is the peak up to the end of that
+#stage. Sends back a dictionary with, for each stage, the wall time, the peak
+#memory, the number of rows processed and a checksum of its results. A size
+#whose process fails before sending its results, e.g. on an error in one of
+#the stages, counts as a regression.
+
+def bch_run(rrr_bch_dir, IS_riv_tot, IS_orb_tot, IS_tim_tot, IS_wrk, rrr_pip):
+     ZS_dom=np.sqrt(IS_riv_tot)*0.2
+     rrr_riv_shp=os.path.join(rrr_bch_dir, 'riv_'+str(IS_riv_tot)+'.shp')
+     rrr_orb_shp=os.path.join(rrr_bch_dir, 'orb_'+str(IS_riv_tot)+'_'         \
+                                            +str(IS_orb_tot)+'.shp')
+     rrr_mod_nc=os.path.join(rrr_bch_dir, 'Qout_'+str(IS_riv_tot)+'_'         \
+                                          +str(IS_tim_tot)+'.nc')
+     if not os.path.isfile(rrr_riv_shp):
+          bch_riv(rrr_riv_shp, IS_riv_tot, ZS_dom)
+     if not os.path.isfile(rrr_orb_shp):
+          bch_orb(rrr_orb_shp, IS_orb_tot, ZS_dom)
+     rrr_mod_nc3=rrr_mod_nc[:-3]+'_nc3.nc'
+     if not os.path.isfile(rrr_mod_nc):
+          bch_qou(rrr_mod_nc, IS_riv_tot, IS_tim_tot)
+     if not os.path.isfile(rrr_mod_nc3):
+          bch_qou(rrr_mod_nc3, IS_riv_tot, IS_tim_tot, 'NETCDF3_CLASSIC')
+
+     YM_res={}
+     def bch_stg(YS_stg, ZS_beg, IS_row, YV_chk):
+          YM_res[YS_stg]={'time': time.time()-ZS_beg,                          \
+                          'peak_rss_mb':                                       \
+                          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss   \
+                          /1024.0,                                             \
+                          'rows': int(IS_row),                                 \
+                          'checksum': hashlib.sha1(b''.join(                   \
+                               np.ascontiguousarray(x).tobytes()               \
+                               for x in YV_chk)).hexdigest()}
+
+     ZS_beg=time.time()
+     YV_riv_id,IV_riv_tot_id,riv_geo=rrr_swt_ovl_lib.riv_shp_read(rrr_riv_shp)
+     bch_stg('read_rivers', ZS_beg, len(riv_geo), [IV_riv_tot_id])
+
+     ZS_beg=time.time()
+     ZV_orb_tim,orb_geo=rrr_swt_ovl_lib.orb_shp_read(rrr_orb_shp)
+     bch_stg('read_orbits', ZS_beg, len(orb_geo), [ZV_orb_tim])
+
+     ZS_beg=time.time()
+     IV_ovl_orb,IV_ovl_riv,IV_cnd_cnt,IV_tst_cnt=                              \
+                         rrr_swt_ovl_lib.ovl_riv_orb_par(riv_geo, orb_geo, IS_wrk)
+     bch_stg('overlay', ZS_beg, len(IV_ovl_riv), [IV_ovl_orb, IV_ovl_riv])
+
+     for YS_stg,rrr_smp_nc in [('sample', rrr_mod_nc),                        \
+                               ('sample_netcdf3', rrr_mod_nc3)]:
+          ZS_beg=time.time()
+          IS_row=0
+          ZV_qou_sum=np.zeros(1, dtype=np.float64)
+          for rrr_ovl_df_qout in rrr_swt_mod_lib.ovl_smp(rrr_smp_nc,           \
+                                 IV_riv_tot_id[IV_ovl_riv],                    \
+                                 ZV_orb_tim[IV_ovl_orb]):
+               IS_row=IS_row+len(rrr_ovl_df_qout)
+               ZV_qou_sum=ZV_qou_sum                                           \
+                         +rrr_ovl_df_qout['Qout'].values.sum(dtype=np.float64)
+          bch_stg(YS_stg, ZS_beg, IS_row, [np.round(ZV_qou_sum, 3)])
+
+     rrr_pip.send(YM_res)
+     rrr_pip.close()
+
+
+#*******************************************************************************
+#Get command line arguments
+#*******************************************************************************
+YV_arg,YM_opt=rrr_swt_arg_lib.arg_get(2, ['sizes', 'orbits', 'steps',          \
+                                         'workers', 'baseline', 'slowdown'])
+
+rrr_bch_dir=YV_arg[0]
+rrr_bch_json=YV_arg[1]
+IV_riv_siz=[int(x) for x in YM_opt.get('sizes', '1000,10000').split(',')]
+IS_orb_tot=rrr_swt_arg_lib.opt_int(YM_opt, 'orbits', 100)
+IS_tim_tot=rrr_swt_arg_lib.opt_int(YM_opt, 'steps', 2920)
+IS_wrk=rrr_swt_arg_lib.opt_int(YM_opt, 'workers', 1)
+rrr_bch_old=YM_opt.get('baseline', '')
+ZS_slo=rrr_swt_arg_lib.opt_float(YM_opt, 'slowdown', 1.5)
+
+ZS_noi=0.05
+#Stage times differing from the baseline by less than ZS_noi seconds are noise
+
+
+#*******************************************************************************
+#Print input information
+#*******************************************************************************
+print('Command line inputs')
+print('- '+rrr_bch_dir)
+print('- '+rrr_bch_json)
+print('- River network sizes: '+', '.join(str(x) for x in IV_riv_siz))
+print('- Number of orbit passes: '+str(IS_orb_tot))
+print('- Number of model time steps: '+str(IS_tim_tot))
+if rrr_bch_old != '':
+     print('- Baseline: '+rrr_bch_old)
+
+
+#*******************************************************************************
+#Check if files exist
+#*******************************************************************************
+if not os.path.isdir(rrr_bch_dir):
+     os.makedirs(rrr_bch_dir)
+
+YM_bch_old={}
+if rrr_bch_old != '':
+     try:
+          with open(rrr_bch_old, 'r') as jsonfile:
+               YM_bch_old=json.load(jsonfile)
+     except IOError as e:
+          print('ERROR - Unable to open '+rrr_bch_old)
+          raise SystemExit(22)
+
+
+#*******************************************************************************
+#Run the benchmark
+#*******************************************************************************
+print('Run the benchmark')
+
+YM_bch={}
+IS_reg=0
+mp_ctx=multiprocessing.get_context('fork')
+for IS_riv_tot in IV_riv_siz:
+     rrr_pip_par,rrr_pip_chi=mp_ctx.Pipe()
+     rrr_prc=mp_ctx.Process(target=bch_run, args=(rrr_bch_dir, IS_riv_tot,     \
+                            IS_orb_tot, IS_tim_tot, IS_wrk, rrr_pip_chi))
+     rrr_prc.start()
+     rrr_pip_chi.close()
+     try:
+          YM_res=rrr_pip_par.recv()
+     except EOFError:
+          YM_res=None
+     rrr_pip_par.close()
+     rrr_prc.join()
+     if YM_res is None or rrr_prc.exitcode != 0:
+          print('- '+str(IS_riv_tot)+' river reaches: FAILED with exit code '  \
+                +str(rrr_prc.exitcode))
+          IS_reg=IS_reg+1
+          continue
+     YM_bch[str(IS_riv_tot)]=YM_res
+     print('- '+str(IS_riv_tot)+' river reaches')
+     for YS_stg in YM_res:
+          print('  - '+YS_stg.ljust(14)                                        \
+                +' {time:9.3f} s {peak_rss_mb:9.1f} MB {rows:10d} rows'        \
+                .format(**YM_res[YS_stg]))
+
+
+#*******************************************************************************
+#Compare with the baseline
+#*******************************************************************************
+if rrr_bch_old != '':
+     print('Compare with the baseline')
+     for YS_siz in YM_bch:
+          if YS_siz not in YM_bch_old:
+               print('- '+YS_siz+' river reaches: not in baseline')
+               continue
+          for YS_stg in YM_bch[YS_siz]:
+               YM_new=YM_bch[YS_siz][YS_stg]
+               YM_old=YM_bch_old[YS_siz].get(YS_stg)
+               if YM_old is None:
+                    continue
+               ZS_rat=YM_new['time']/max(YM_old['time'], 1e-6)
+               YS_sta='ok'
+               if YM_new['checksum'] != YM_old['checksum']:
+                    YS_sta='RESULTS DIFFER'
+                    IS_reg=IS_reg+1
+               elif ZS_rat > ZS_slo and YM_new['time']-YM_old['time'] > ZS_noi:
+                    YS_sta='SLOWER'
+                    IS_reg=IS_reg+1
+               print('- '+YS_siz+' river reaches, '+YS_stg+': '                \
+                     +'{:.2f}'.format(ZS_rat)+'x baseline time, '+YS_sta)
+
+
+#*******************************************************************************
+#Write outputs
+#*******************************************************************************
+print('Writing rrr_bch_json')
+
+with open(rrr_bch_json, 'w') as jsonfile:
+     json.dump(YM_bch, jsonfile, indent=1, sort_keys=True)
+
+if IS_reg > 0:
+     print('ERROR - '+str(IS_reg)+' regressions against the baseline or '     \
+           +'failed sizes')
+     raise SystemExit(1)
+
+
+#*******************************************************************************
+#End
+#*******************************************************************************
@@ -0,0 +1,813 @@
+#!/usr/bin/python
+#******************************************************************************
+#rrr_swt_mod_lib.py
+#******************************************************************************
+#Purpose:
+#Sampling of river model outputs at the times of SWOT orbit overlays, shared by
+#the SWOT orbit scripts. The (reach, time) cells to sample can also be compiled
+#once into a sampling plan and applied to other model outputs with the same
+#reach and time axes, such as all the members of an ensemble at once. Large
+#jobs can be split into partitions of reaches run on a pool of processes or on
+#a Dask cluster.
+#Authors:
+#Cedric H. David, Etienne Fluet-Chouinard, 2016-2016
+
+
+#*******************************************************************************
+#Import Python modules
+#*******************************************************************************
+import os
+import glob
+import shutil
+import hashlib
+import multiprocessing
+import concurrent.futures
+import netCDF4
+import numpy as np
+import pandas as pd
+import rrr_swt_out_lib
+import rrr_swt_prf_lib
+
+
+#*******************************************************************************
+#Declaration of variables
+#*******************************************************************************
+YV_pln_arr=['IV_riv_id', 'IV_riv_col', 'IV_clo', 'ZV_tim', 'ZV_clo_tim',
+            'ZV_sec_dif']
+YV_pln_typ=['i8', 'i4', 'i4', 'f8', 'i8', 'f8']
+#The arrays of a sampling plan and their data type
+
+YV_est_all=['linear', 'mean', 'min', 'max']
+#The estimators of Qout at the pass times besides the closest model time step
+
+IS_slb_max=4194304
+#The maximum number of cells of Qout read as one hyperslab (16 MB in float32)
+
+YM_tim_unt={'seconds': 1, 'second': 1, 'secs': 1, 'sec': 1, 's': 1,
+            'minutes': 60, 'minute': 60, 'mins': 60, 'min': 60,
+            'hours': 3600, 'hour': 3600, 'hrs': 3600, 'hr': 3600, 'h': 3600,
+            'days': 86400, 'day': 86400, 'd': 86400}
+#The number of seconds in each unit of a CF time axis
+
+
+#*******************************************************************************
+#Count the orbit cycles covering a time window
+#*******************************************************************************
+#Returns the number of repeat cycles of ZS_cyc seconds needed for the earliest
+#overlay time in ZV_ovl_tim to reach the end of the window ZS_win_end.
+
+def cyc_cnt(ZV_ovl_tim, ZS_cyc, ZS_win_end):
+     if len(ZV_ovl_tim) == 0:
+          return 0
+     return max(0, int(np.floor((ZS_win_end-np.min(ZV_ovl_tim))/ZS_cyc))+1)
+
+
+#*******************************************************************************
+#Expand overlay times over orbit cycles
+#*******************************************************************************
+#Repeats the overlay times of the initial cycle for cycles IS_cyc_beg to
+#IS_cyc_end-1 by adding multiples of ZS_cyc seconds in one broadcast operation.
+#Returns the row of each expanded time in ZV_ovl_tim and the expanded times,
+#cycle after cycle.
+
+def cyc_expand(ZV_ovl_tim, ZS_cyc, IS_cyc_beg, IS_cyc_end):
+     ZV_ovl_tim=np.asarray(ZV_ovl_tim)
+     ZV_cyc_off=np.arange(IS_cyc_beg, IS_cyc_end)*ZS_cyc
+     IV_row=np.tile(np.arange(len(ZV_ovl_tim)), len(ZV_cyc_off))
+     ZV_tim=(ZV_cyc_off[:, None]+ZV_ovl_tim[None, :]).ravel()
+     return IV_row, ZV_tim
+
+
+#*******************************************************************************
+#Find the closest model time
+#*******************************************************************************
+#For each overlay time in ZV_ovl_tim, finds the closest time in the model time
+#axis ZV_mod_tim using a binary search of the sorted axis, in one batched call.
+#The axis does not need to be sorted, and ties are resolved towards the earlier
+#model time. Returns the index of the closest time in ZV_mod_tim, the closest
+#time itself and the absolute difference in seconds between both.
+
+def tim_closest(ZV_ovl_tim, ZV_mod_tim):
+     ZV_mod_tim=np.asarray(ZV_mod_tim)
+     IV_mod_srt=np.argsort(ZV_mod_tim, kind='stable')
+     ZV_mod_srt=ZV_mod_tim[IV_mod_srt]
+     ZV_ovl_tim=np.asarray(ZV_ovl_tim)
+
+     IV_aft=np.searchsorted(ZV_mod_srt, ZV_ovl_tim, side='left')
+     IV_aft=np.clip(IV_aft, 1, len(ZV_mod_srt)-1) if len(ZV_mod_srt) > 1     \
+            else np.zeros(len(ZV_ovl_tim), dtype=np.int64)
+     IV_bef=np.maximum(IV_aft-1, 0)
+     ZV_dif_bef=np.abs(ZV_ovl_tim-ZV_mod_srt[IV_bef])
+     ZV_dif_aft=np.abs(ZV_mod_srt[IV_aft]-ZV_ovl_tim)
+
+     BV_bef=ZV_dif_bef <= ZV_dif_aft
+     IV_clo=np.where(BV_bef, IV_bef, IV_aft)
+     ZV_sec_dif=np.where(BV_bef, ZV_dif_bef, ZV_dif_aft)
+     return IV_mod_srt[IV_clo], ZV_mod_tim[IV_mod_srt[IV_clo]], ZV_sec_dif
+
+
+#*******************************************************************************
+#Read the reach IDs and time axis of a model output file
+#*******************************************************************************
+#Returns the name of the reach and time dimensions of the Qout variable, the
+#reach IDs and the time axis, without reading Qout itself. The time axis is
+#given in seconds since the first model time step, as are the overlay times:
+#- a time variable with CF units ('<unit> since <date>', e.g. 'seconds since
+#  1970-01-01 00:00:00' in RAPID outputs) is decoded with these units,
+#- a time variable without units, or a time dimension without variable, holds
+#  time step indices, converted with the model time step ZS_mod_dtm.
+#Time variables with other units are rejected. Trailing time steps whose time is
+#masked or equal to the fill value have not been written yet, e.g. in an output
+#that is still being written, and are left out of the time axis.
+
+def mod_nc_axes(rrr_mod_nc, ZS_mod_dtm=3*60*60):
+     with netCDF4.Dataset(rrr_mod_nc, 'r') as rrr_mod_dat:
+          if 'Qout' not in rrr_mod_dat.variables:
+               print('ERROR - Qout does not exist in '+rrr_mod_nc)
+               raise SystemExit(22)
+          YV_dim=rrr_mod_dat.variables['Qout'].dimensions
+          YS_riv_dim=[x for x in YV_dim if x in ['COMID', 'rivid']]
+          YS_tim_dim=[x for x in YV_dim if x in ['Time', 'time']]
+          if len(YS_riv_dim) != 1 or len(YS_tim_dim) != 1:
+               print('ERROR - Qout must have one reach dimension (COMID or '   \
+                     +'rivid) and one time dimension (Time or time) in '       \
+                     +rrr_mod_nc)
+               raise SystemExit(22)
+          YS_riv_dim=YS_riv_dim[0]
+          YS_tim_dim=YS_tim_dim[0]
+          IV_mod_id=rrr_mod_dat.variables[YS_riv_dim][:].astype(np.int64)
+          if YS_tim_dim not in rrr_mod_dat.variables:
+               ZV_mod_tim=np.arange(len(rrr_mod_dat.dimensions[YS_tim_dim]))    \
+                          *ZS_mod_dtm
+               return YS_riv_dim, YS_tim_dim, IV_mod_id,                        \
+                      ZV_mod_tim.astype(np.int64)
+          rrr_tim_var=rrr_mod_dat.variables[YS_tim_dim]
+          rrr_tim_var.set_auto_mask(True)
+          ZV_mod_tim=rrr_tim_var[:]
+          BV_tim_val=~np.ma.getmaskarray(ZV_mod_tim)
+          ZV_mod_tim=np.ma.getdata(ZV_mod_tim).astype(np.float64)
+          if '_FillValue' in rrr_tim_var.ncattrs():
+               BV_tim_val&=ZV_mod_tim != float(rrr_tim_var._FillValue)
+          BV_tim_val&=np.isfinite(ZV_mod_tim)
+          IS_tim_val=len(BV_tim_val)-int(np.argmax(BV_tim_val[::-1]))          \
+                     if BV_tim_val.any() else 0
+          if not BV_tim_val[:IS_tim_val].all():
+               print('ERROR - '+YS_tim_dim+' has missing values before its last '\
+                     +'valid value in '+rrr_mod_nc)
+               raise SystemExit(22)
+          ZV_mod_tim=ZV_mod_tim[:IS_tim_val]
+          if 'units' not in rrr_tim_var.ncattrs():
+               ZV_mod_tim=ZV_mod_tim*ZS_mod_dtm
+          else:
+               YS_tim_unt=rrr_tim_var.units
+               YV_tim_unt=YS_tim_unt.strip().split(None, 2)
+               if len(YV_tim_unt) != 3 or YV_tim_unt[1].lower() != 'since'     \
+                  or YV_tim_unt[0].lower() not in YM_tim_unt:
+                    print('ERROR - The units of '+YS_tim_dim+' in '+rrr_mod_nc \
+                          +' must be <unit> since <date>, not: '+YS_tim_unt)
+                    raise SystemExit(22)
+               if len(ZV_mod_tim) > 0:
+                    ZV_mod_tim=np.round((ZV_mod_tim-ZV_mod_tim[0])              \
+                                        *YM_tim_unt[YV_tim_unt[0].lower()])
+     return YS_riv_dim, YS_tim_dim, IV_mod_id, ZV_mod_tim.astype(np.int64)
+
+
+#*******************************************************************************
+#Find the end of the time axis of a model output file that is being written
+#*******************************************************************************
+#Returns the number of written time steps of rrr_mod_nc and the latest time, in
+#seconds, of its written time steps but the last IS_hld ones, which may still be
+#incomplete, or -inf if there are not enough time steps.
+
+def mod_nc_end(rrr_mod_nc, IS_hld=0, ZS_mod_dtm=3*60*60):
+     YS_riv_dim,YS_tim_dim,IV_mod_id,IV_mod_tim_sec=mod_nc_axes(rrr_mod_nc,    \
+                                                                ZS_mod_dtm)
+     IS_tim_tot=len(IV_mod_tim_sec)
+     if IS_tim_tot <= IS_hld:
+          return IS_tim_tot, -np.inf
+     return IS_tim_tot, int(IV_mod_tim_sec[:IS_tim_tot-IS_hld].max())
+
+
+#*******************************************************************************
+#Find the column of each reach in the model output
+#*******************************************************************************
+#Returns, for each reach ID in IV_riv_id, the index of that reach along the
+#reach dimension of Qout, or -1 if the reach is not in the model output.
+
+def riv_col(IV_mod_id, IV_riv_id):
+     IV_mod_srt=np.argsort(IV_mod_id, kind='stable')
+     IV_mod_id_srt=IV_mod_id[IV_mod_srt]
+     IV_pos=np.searchsorted(IV_mod_id_srt, IV_riv_id)
+     IV_pos=np.minimum(IV_pos, len(IV_mod_id_srt)-1)
+     BV_fnd=IV_mod_id_srt[IV_pos] == IV_riv_id
+     return np.where(BV_fnd, IV_mod_srt[IV_pos], -1)
+
+
+#*******************************************************************************
+#Find the layout of Qout
+#*******************************************************************************
+#Returns whether time is the first dimension of the Qout variable rrr_qou_var,
+#and its chunk sizes along the time and reach dimensions. Variables that are
+#not chunked, either contiguous or from netCDF-3 files for which chunking() is
+#None, are read one time step at a time in runs of 256 reaches.
+
+def qout_chk(rrr_qou_var):
+     BS_tim_fst=rrr_qou_var.dimensions[0] in ['Time', 'time']
+     YV_chk=rrr_qou_var.chunking()
+     if YV_chk is None or YV_chk == 'contiguous':
+          return BS_tim_fst, 1, 256
+     elif BS_tim_fst:
+          return BS_tim_fst, YV_chk[0], YV_chk[1]
+     else:
+          return BS_tim_fst, YV_chk[1], YV_chk[0]
+
+
+#*******************************************************************************
+#Gather Qout values at given (time, reach) cells
+#*******************************************************************************
+#Reads Qout only at the cells (IV_tim[i], IV_col[i]) given by their indices
+#along the time and reach dimensions. The cells are sorted and processed one
+#block of time steps at a time; within a block the needed reach columns are
+#coalesced into contiguous runs, with gaps of up to IS_gap columns, and each
+#run is read as one hyperslab. Block and gap sizes default to those of
+#qout_chk(), i.e. to the chunk sizes of chunked Qout variables so that every
+#chunk is decompressed at most once per block. Runs are cut at multiples of
+#IS_gap columns so that no hyperslab exceeds IS_slb cells, or one block of
+#IS_gap columns if that is larger. Peak memory is one hyperslab, and does not
+#depend on the size of the model output.
+
+def qout_gather(rrr_mod_nc, IV_tim, IV_col, IS_blk=None, IS_gap=None,         \
+                IS_slb=IS_slb_max):
+     IV_tim=np.asarray(IV_tim, dtype=np.int64)
+     IV_col=np.asarray(IV_col, dtype=np.int64)
+     ZV_qou=np.empty(len(IV_tim), dtype=np.float32)
+     if len(IV_tim) == 0:
+          return ZV_qou
+
+     with netCDF4.Dataset(rrr_mod_nc, 'r') as rrr_mod_dat:
+          rrr_qou_var=rrr_mod_dat.variables['Qout']
+          rrr_qou_var.set_auto_mask(False)
+          BS_tim_fst,IS_chk_tim,IS_chk_col=qout_chk(rrr_qou_var)
+          if IS_blk is None:
+               IS_blk=IS_chk_tim
+          if IS_gap is None:
+               IS_gap=IS_chk_col
+
+          IV_srt=np.lexsort((IV_col, IV_tim))
+          IV_tim_srt=IV_tim[IV_srt]
+          IV_col_srt=IV_col[IV_srt]
+          IV_blk=IV_tim_srt//IS_blk
+          IV_blk_brk=np.flatnonzero(np.diff(IV_blk))+1
+          for IV_sel in np.split(np.arange(len(IV_srt)), IV_blk_brk):
+               IS_tim_beg=int(IV_tim_srt[IV_sel].min())
+               IS_tim_end=int(IV_tim_srt[IV_sel].max())+1
+               IV_col_unq=np.unique(IV_col_srt[IV_sel])
+               IS_run_max=max(1, IS_slb//(IS_tim_end-IS_tim_beg)//IS_gap)*IS_gap
+               IV_run_brk=np.flatnonzero((np.diff(IV_col_unq) > IS_gap)        \
+                                         | (np.diff(IV_col_unq//IS_run_max) > 0))+1
+               for IV_run in np.split(IV_col_unq, IV_run_brk):
+                    IS_col_beg=int(IV_run[0])
+                    IS_col_end=int(IV_run[-1])+1
+                    if BS_tim_fst:
+                         ZM_qou=rrr_qou_var[IS_tim_beg:IS_tim_end,             \
+                                            IS_col_beg:IS_col_end]
+                    else:
+                         ZM_qou=rrr_qou_var[IS_col_beg:IS_col_end,             \
+                                            IS_tim_beg:IS_tim_end].T
+                    IV_cel=IV_sel[(IV_col_srt[IV_sel] >= IS_col_beg) &         \
+                                  (IV_col_srt[IV_sel] < IS_col_end)]
+                    ZV_qou[IV_srt[IV_cel]]=                                    \
+                              ZM_qou[IV_tim_srt[IV_cel]-IS_tim_beg,            \
+                                     IV_col_srt[IV_cel]-IS_col_beg]
+     return ZV_qou
+
+
+#*******************************************************************************
+#Estimate Qout at the pass times
+#*******************************************************************************
+#Besides the value at the closest model time step IV_clo, computes the
+#estimators YV_est of Qout at each pass time ZV_tim and reach column IV_col,
+#given the model time axis ZV_mod_tim in seconds:
+#- 'linear': linear interpolation between the model time steps bracketing the
+#  pass, or the first or last step for passes outside of the time axis,
+#- 'mean', 'min', 'max': statistics over the model time steps within ZS_est_win
+#  seconds of the pass, or NaN if there are none.
+#The cells needed by all estimators are gathered together, each once, with one
+#call to qout_gather(). Returns the values at the closest time steps and a
+#dictionary with the values of each estimator. est_chk() stops with an error
+#if any of the estimators YV_est is unknown.
+
+def est_chk(YV_est):
+     for YS_est in YV_est:
+          if YS_est not in YV_est_all:
+               print('ERROR - Unknown estimator: '+str(YS_est))
+               print('- The estimators must be among: '+', '.join(YV_est_all))
+               raise SystemExit(22)
+
+def qout_est(rrr_mod_nc, ZV_tim, IV_col, IV_clo, ZV_mod_tim, YV_est,          \
+             ZS_est_win):
+     est_chk(YV_est)
+     ZV_tim=np.asarray(ZV_tim, dtype=np.float64)
+     IV_col=np.asarray(IV_col, dtype=np.int64)
+     IV_mod_srt=np.argsort(ZV_mod_tim, kind='stable')
+     ZV_mod_srt=np.asarray(ZV_mod_tim, dtype=np.float64)[IV_mod_srt]
+     IS_mod_tim=len(ZV_mod_srt)
+     YV_cel_tim=[np.asarray(IV_clo, dtype=np.int64)]
+     YV_cel_col=[IV_col]
+
+     if 'linear' in YV_est:
+          IV_aft=np.minimum(np.maximum(np.searchsorted(ZV_mod_srt, ZV_tim,    \
+                                       side='right'), 1), IS_mod_tim-1)
+          IV_bef=np.maximum(IV_aft-1, 0)
+          ZV_dtm=ZV_mod_srt[IV_aft]-ZV_mod_srt[IV_bef]
+          with np.errstate(divide='ignore', invalid='ignore'):
+               ZV_wgt=np.where(ZV_dtm > 0,                                     \
+                               (ZV_tim-ZV_mod_srt[IV_bef])/ZV_dtm, 0.0)
+          ZV_wgt=np.clip(ZV_wgt, 0.0, 1.0)
+          YV_cel_tim+=[IV_mod_srt[IV_bef], IV_mod_srt[IV_aft]]
+          YV_cel_col+=[IV_col, IV_col]
+
+     BS_win=any(x in YV_est for x in ['mean', 'min', 'max'])
+     if BS_win:
+          IV_win_beg=np.searchsorted(ZV_mod_srt, ZV_tim-ZS_est_win, side='left')
+          IV_win_end=np.searchsorted(ZV_mod_srt, ZV_tim+ZS_est_win, side='right')
+          IV_win_cnt=IV_win_end-IV_win_beg
+          IV_win_off=np.concatenate(([0], np.cumsum(IV_win_cnt)))
+          IV_win_pas=np.repeat(np.arange(len(ZV_tim)), IV_win_cnt)
+          IV_win_pos=IV_win_beg[IV_win_pas]                                    \
+                    +np.arange(IV_win_off[-1])-IV_win_off[IV_win_pas]
+          YV_cel_tim+=[IV_mod_srt[IV_win_pos]]
+          YV_cel_col+=[IV_col[IV_win_pas]]
+
+     #--------------------------------------------------------------------------
+     #Gather each needed cell once
+     #--------------------------------------------------------------------------
+     IV_cel_tim=np.concatenate(YV_cel_tim)
+     IV_cel_col=np.concatenate(YV_cel_col)
+     IS_col_tot=int(IV_cel_col.max())+1 if len(IV_cel_col) > 0 else 1
+     IV_cel_unq,IV_cel_inv=np.unique(IV_cel_tim*IS_col_tot+IV_cel_col,         \
+                                     return_inverse=True)
+     ZV_cel=qout_gather(rrr_mod_nc, IV_cel_unq//IS_col_tot,                   \
+                        IV_cel_unq % IS_col_tot)[IV_cel_inv.ravel()]
+     YV_cel=np.split(ZV_cel, np.cumsum([len(x) for x in YV_cel_tim])[:-1])
+
+     #--------------------------------------------------------------------------
+     #Compute the estimators
+     #--------------------------------------------------------------------------
+     YM_est={}
+     if 'linear' in YV_est:
+          YM_est['linear']=((1-ZV_wgt)*YV_cel[1]+ZV_wgt*YV_cel[2])             \
+                           .astype(np.float32)
+     if BS_win:
+          ZV_win=YV_cel[-1].astype(np.float64)
+          BV_win=IV_win_cnt > 0
+          IV_win_idx=IV_win_off[:-1][BV_win]
+          for YS_est,ZV_est_fun in [('mean', np.add), ('min', np.minimum),     \
+                                    ('max', np.maximum)]:
+               if YS_est not in YV_est:
+                    continue
+               ZV_est=np.full(len(ZV_tim), np.nan)
+               if len(IV_win_idx) > 0:
+                    ZV_est[BV_win]=ZV_est_fun.reduceat(ZV_win, IV_win_idx)
+               if YS_est == 'mean':
+                    ZV_est=ZV_est/np.maximum(IV_win_cnt, 1)
+               YM_est[YS_est]=ZV_est.astype(np.float32)
+     return YV_cel[0], YM_est
+
+
+#*******************************************************************************
+#Plan the sampling of the model output at the times of the overlays
+#*******************************************************************************
+#Takes the reach ID and time of each overlay during the initial orbit cycle,
+#repeats the overlays over orbit cycles of ZS_cyc seconds and matches each pass
+#to the closest model time step. The model time axis is read in seconds by
+#mod_nc_axes(), with the model time step ZS_mod_dtm for axes of time step
+#indices. Unless a number of cycles IS_cyc is given, the cycles are repeated
+#over the time axis of the model and the passes outside of it are dropped.
+#Passes farther than ZS_tol seconds from any model time step are dropped if
+#ZS_tol is given. If a window ZV_win=(ZS_aft, ZS_end) is given, only the passes
+#after ZS_aft and up to ZS_end seconds are kept, and the cycles ending before
+#ZS_aft are not expanded. This is a generator that expands about IS_row_blk
+#passes at a time and yields, for each block, at least one even if empty, the
+#reach ID, the index along the reach dimension of Qout, the index along its time
+#dimension, the pass time, the closest model time and the difference between
+#both of each pass.
+#The overlays can also be given in the compressed sparse row format of
+#rrr_swt_ovl_lib.ovl_csr(), with the unique reach IDs in IV_ovl_id and their
+#offsets in IV_ovl_off, in which case the reaches are looked up in the model
+#output once each rather than once per overlay, and only the overlays of the
+#reaches found are expanded. The overlays are copied in both cases since they
+#are sorted by time.
+
+def ovl_pln(rrr_mod_nc, IV_ovl_id, ZV_ovl_tim, ZS_cyc=1802700, IS_cyc=None,  \
+            ZS_tol=None, ZS_mod_dtm=3*60*60, IS_row_blk=1000000, ZV_win=None, \
+            IV_ovl_off=None):
+
+     #--------------------------------------------------------------------------
+     #Read the reach IDs and time axis of the model output
+     #--------------------------------------------------------------------------
+     with rrr_swt_prf_lib.prf_stg('read_axes'):
+          YS_riv_dim,YS_tim_dim,IV_mod_id,IV_mod_tim_sec=                      \
+                                           mod_nc_axes(rrr_mod_nc, ZS_mod_dtm)
+
+     #--------------------------------------------------------------------------
+     #Keep only the reaches that are in the model output
+     #--------------------------------------------------------------------------
+     IV_ovl_id=np.asarray(IV_ovl_id, dtype=np.int64)
+     ZV_ovl_tim=np.asarray(ZV_ovl_tim, dtype=np.float64)
+     IV_ovl_col=riv_col(IV_mod_id, IV_ovl_id)
+     BV_ovl=IV_ovl_col >= 0
+     if IV_ovl_off is None:
+          rrr_ovl_df=pd.DataFrame({'IS_riv_id': IV_ovl_id[BV_ovl],
+                                   'IM_ovl_tim': ZV_ovl_tim[BV_ovl],
+                                   'IS_riv_col': IV_ovl_col[BV_ovl]})
+     else:
+          IV_ovl_cnt=np.diff(IV_ovl_off)
+          rrr_ovl_df=pd.DataFrame({'IS_riv_id': np.repeat(IV_ovl_id[BV_ovl],
+                                                          IV_ovl_cnt[BV_ovl]),
+                                   'IM_ovl_tim': ZV_ovl_tim[np.repeat(BV_ovl,
+                                                              IV_ovl_cnt)],
+                                   'IS_riv_col': np.repeat(IV_ovl_col[BV_ovl],
+                                                           IV_ovl_cnt[BV_ovl])})
+
+     #--------------------------------------------------------------------------
+     #Sort the overlays by time
+     #--------------------------------------------------------------------------
+     rrr_ovl_df=rrr_ovl_df.sort_values(by='IM_ovl_tim', kind='stable')
+     rrr_ovl_df=rrr_ovl_df.reset_index(drop=True)
+
+     #--------------------------------------------------------------------------
+     #Determine the number of orbit cycles
+     #--------------------------------------------------------------------------
+     if IS_cyc is None:
+          ZS_win_beg=IV_mod_tim_sec.min()
+          ZS_win_end=IV_mod_tim_sec.max()
+          IS_cyc=cyc_cnt(rrr_ovl_df['IM_ovl_tim'].values, ZS_cyc, ZS_win_end)
+     else:
+          ZS_win_beg=-np.inf
+          ZS_win_end=np.inf
+     print('- Number of orbit cycles: '+str(IS_cyc))
+
+     #--------------------------------------------------------------------------
+     #Restrict the passes to a window
+     #--------------------------------------------------------------------------
+     IS_cyc_fst=0
+     if ZV_win is not None:
+          ZS_win_beg=max(ZS_win_beg, np.nextafter(ZV_win[0], np.inf))
+          ZS_win_end=min(ZS_win_end, ZV_win[1])
+          if np.isfinite(ZV_win[0]) and len(rrr_ovl_df) > 0:
+               IS_cyc_fst=max(0, int(np.floor((ZV_win[0]                       \
+                                   -rrr_ovl_df['IM_ovl_tim'].max())/ZS_cyc))+1)
+
+     #--------------------------------------------------------------------------
+     #Expand and match one block of cycles at a time
+     #--------------------------------------------------------------------------
+     IS_cyc_blk=max(1, IS_row_blk//max(1, len(rrr_ovl_df)))
+     for JS_cyc_beg in range(IS_cyc_fst, max(IS_cyc, IS_cyc_fst+1), IS_cyc_blk):
+          with rrr_swt_prf_lib.prf_stg('expand_cycles'):
+               IV_row,ZV_tim=cyc_expand(rrr_ovl_df['IM_ovl_tim'].values,       \
+                                        ZS_cyc, JS_cyc_beg,                    \
+                                        min(JS_cyc_beg+IS_cyc_blk, IS_cyc))
+               BV_win=(ZV_tim >= ZS_win_beg) & (ZV_tim <= ZS_win_end)
+               IV_row=IV_row[BV_win]
+               ZV_tim=ZV_tim[BV_win]
+          rrr_swt_prf_lib.prf_cnt('expand_cycles', 'rows', len(IV_row))
+
+          with rrr_swt_prf_lib.prf_stg('match_time'):
+               IV_clo,ZV_clo_tim,ZV_sec_dif=tim_closest(ZV_tim, IV_mod_tim_sec)
+               if ZS_tol is not None:
+                    BV_tol=ZV_sec_dif <= ZS_tol
+                    IV_row=IV_row[BV_tol]
+                    ZV_tim=ZV_tim[BV_tol]
+                    IV_clo=IV_clo[BV_tol]
+                    ZV_clo_tim=ZV_clo_tim[BV_tol]
+                    ZV_sec_dif=ZV_sec_dif[BV_tol]
+          rrr_swt_prf_lib.prf_cnt('match_time', 'rows', len(IV_row))
+
+          yield rrr_ovl_df['IS_riv_id'].values[IV_row],                        \
+                rrr_ovl_df['IS_riv_col'].values[IV_row], IV_clo, ZV_tim,       \
+                ZV_clo_tim, ZV_sec_dif
+
+
+#*******************************************************************************
+#Sample the model output at the times of the overlays
+#*******************************************************************************
+#Samples Qout at the passes planned by ovl_pln(), which takes the same
+#arguments, including the offsets IV_ovl_off of overlays in compressed sparse
+#row format. This is a generator that yields one data frame per block of
+#ovl_pln(), at least one even if empty, with columns IS_riv_id, IM_ovl_tim,
+#closest_rrr_time, secs_diff and Qout, and an index that continues from block
+#to block. The estimators YV_est of qout_est() are added as columns
+#Qout_<estimator>, with windows of ZS_est_win seconds (default: the median
+#time step of the model output).
+
+def ovl_smp(rrr_mod_nc, IV_ovl_id, ZV_ovl_tim, ZS_cyc=1802700, IS_cyc=None,  \
+            ZS_tol=None, ZS_mod_dtm=3*60*60, IS_row_blk=1000000, ZV_win=None, \
+            YV_est=None, ZS_est_win=None, IV_ovl_off=None):
+     if YV_est:
+          est_chk(YV_est)
+          YS_riv_dim,YS_tim_dim,IV_mod_id,IV_mod_tim_sec=                      \
+                                           mod_nc_axes(rrr_mod_nc, ZS_mod_dtm)
+          ZV_mod_dtm=np.diff(np.unique(IV_mod_tim_sec))
+          if ZS_est_win is None:
+               ZS_est_win=float(np.median(ZV_mod_dtm)) if len(ZV_mod_dtm) > 0  \
+                          else ZS_mod_dtm
+     IS_row_out=0
+     for IV_riv_id,IV_riv_col,IV_clo,ZV_tim,ZV_clo_tim,ZV_sec_dif in          \
+         ovl_pln(rrr_mod_nc, IV_ovl_id, ZV_ovl_tim, ZS_cyc, IS_cyc, ZS_tol,    \
+                 ZS_mod_dtm, IS_row_blk, ZV_win, IV_ovl_off):
+          with rrr_swt_prf_lib.prf_stg('read_qout'):
+               if YV_est:
+                    ZV_qou,YM_est=qout_est(rrr_mod_nc, ZV_tim, IV_riv_col,     \
+                                           IV_clo, IV_mod_tim_sec, YV_est,     \
+                                           ZS_est_win)
+               else:
+                    ZV_qou=qout_gather(rrr_mod_nc, IV_clo, IV_riv_col)
+          rrr_swt_prf_lib.prf_cnt('read_qout', 'rows', len(IV_clo))
+
+          rrr_ovl_df_qout=pd.DataFrame(                                        \
+                    {'IS_riv_id': IV_riv_id,                                   \
+                     'IM_ovl_tim': ZV_tim,                                     \
+                     'closest_rrr_time': ZV_clo_tim,                           \
+                     'secs_diff': ZV_sec_dif,                                  \
+                     'Qout': ZV_qou},                                          \
+                    index=pd.RangeIndex(IS_row_out, IS_row_out+len(IV_clo)))
+          if YV_est:
+               for YS_est in YV_est:
+                    rrr_ovl_df_qout['Qout_'+YS_est]=YM_est[YS_est]
+          IS_row_out=IS_row_out+len(IV_clo)
+          yield rrr_ovl_df_qout
+
+
+#*******************************************************************************
+#Fingerprint the axes of a model output file
+#*******************************************************************************
+#Returns a hash of the reach IDs and of the time axis of rrr_mod_nc, which must
+#be identical for a sampling plan to apply to another model output.
+
+def mod_nc_sig(rrr_mod_nc):
+     YS_riv_dim,YS_tim_dim,IV_mod_id,ZV_mod_tim=mod_nc_axes(rrr_mod_nc)
+     rrr_sig=hashlib.sha1()
+     rrr_sig.update(np.ascontiguousarray(IV_mod_id, dtype=np.int64).tobytes())
+     rrr_sig.update(np.ascontiguousarray(ZV_mod_tim, dtype=np.float64).tobytes())
+     return rrr_sig.hexdigest()
+
+
+#*******************************************************************************
+#Compile, write and read a sampling plan
+#*******************************************************************************
+#The plan is the concatenation of all blocks of ovl_pln(): a dictionary of flat
+#arrays with the reach ID, reach index, time index, pass time, closest model
+#time and time difference of each pass, in output order, and the fingerprint
+#of the axes of the model output it was compiled for. It is stored as an
+#uncompressed NumPy .npz file.
+
+def pln_mak(rrr_mod_nc, IV_ovl_id, ZV_ovl_tim, ZS_cyc=1802700, IS_cyc=None,   \
+            ZS_tol=None, ZS_mod_dtm=3*60*60, IS_row_blk=1000000):
+     YM_pln=dict((x, []) for x in YV_pln_arr)
+     for YV_blk in ovl_pln(rrr_mod_nc, IV_ovl_id, ZV_ovl_tim, ZS_cyc, IS_cyc,  \
+                           ZS_tol, ZS_mod_dtm, IS_row_blk):
+          for YS_arr,ZV_arr in zip(YV_pln_arr, YV_blk):
+               YM_pln[YS_arr].append(ZV_arr)
+     for YS_arr,YS_typ in zip(YV_pln_arr, YV_pln_typ):
+          YM_pln[YS_arr]=np.concatenate(YM_pln[YS_arr]).astype(YS_typ)
+     YM_pln['YS_mod_sig']=mod_nc_sig(rrr_mod_nc)
+     return YM_pln
+
+def pln_write(rrr_pln_npz, YM_pln):
+     with open(rrr_pln_npz, 'wb') as rrr_pln_fil:
+          np.savez(rrr_pln_fil, **YM_pln)
+
+def pln_read(rrr_pln_npz):
+     with np.load(rrr_pln_npz, allow_pickle=False) as rrr_pln_dat:
+          if any(x not in rrr_pln_dat for x in YV_pln_arr+['YS_mod_sig']):
+               print('ERROR - Not a sampling plan: '+rrr_pln_npz)
+               raise SystemExit(22)
+          YM_pln=dict((x, rrr_pln_dat[x]) for x in YV_pln_arr)
+          YM_pln['YS_mod_sig']=str(rrr_pln_dat['YS_mod_sig'])
+     return YM_pln
+
+
+#*******************************************************************************
+#Sample the model output following a sampling plan
+#*******************************************************************************
+#Checks that rrr_mod_nc has the same reach and time axes as the model output
+#the plan YM_pln was compiled for, and gathers Qout at all the cells of the plan
+#in one call to qout_gather(). Yields the same data frames as ovl_smp(), in
+#blocks of IS_row_blk rows and at least one even if empty.
+
+def pln_chk(rrr_mod_nc, YM_pln):
+     with rrr_swt_prf_lib.prf_stg('read_axes'):
+          YS_mod_sig=mod_nc_sig(rrr_mod_nc)
+     if YS_mod_sig != YM_pln['YS_mod_sig']:
+          print('ERROR - The reach or time axis of '+rrr_mod_nc+' differs '    \
+                +'from that of the sampling plan')
+          raise SystemExit(22)
+
+def pln_smp(rrr_mod_nc, YM_pln, IS_row_blk=1000000):
+     pln_chk(rrr_mod_nc, YM_pln)
+
+     with rrr_swt_prf_lib.prf_stg('read_qout'):
+          ZV_qou=qout_gather(rrr_mod_nc, YM_pln['IV_clo'], YM_pln['IV_riv_col'])
+     rrr_swt_prf_lib.prf_cnt('read_qout', 'rows', len(ZV_qou))
+
+     for JS_row_beg in range(0, max(len(ZV_qou), 1), IS_row_blk):
+          JS_row_end=min(JS_row_beg+IS_row_blk, len(ZV_qou))
+          yield pd.DataFrame(                                                  \
+                    {'IS_riv_id': YM_pln['IV_riv_id'][JS_row_beg:JS_row_end],  \
+                     'IM_ovl_tim': YM_pln['ZV_tim'][JS_row_beg:JS_row_end],    \
+                     'closest_rrr_time':                                       \
+                                   YM_pln['ZV_clo_tim'][JS_row_beg:JS_row_end],\
+                     'secs_diff': YM_pln['ZV_sec_dif'][JS_row_beg:JS_row_end], \
+                     'Qout': ZV_qou[JS_row_beg:JS_row_end]},                   \
+                    index=pd.RangeIndex(JS_row_beg, JS_row_end))
+
+
+#*******************************************************************************
+#List the members of an ensemble of model outputs
+#*******************************************************************************
+#Splits rrr_mod_nc at commas and expands each part that is a glob pattern into
+#the sorted list of matching files.
+
+def mod_nc_lst(rrr_mod_nc):
+     YV_mod_nc=[]
+     for rrr_mod_pat in rrr_mod_nc.split(','):
+          if any(x in rrr_mod_pat for x in '*?['):
+               YV_mod_nc+=sorted(glob.glob(rrr_mod_pat))
+          else:
+               YV_mod_nc.append(rrr_mod_pat)
+     return YV_mod_nc
+
+
+#*******************************************************************************
+#Sample all the members of an ensemble following a sampling plan
+#*******************************************************************************
+#Same as pln_smp() for each of the model outputs in YV_mod_nc, which must all
+#have the axes of the plan. Qout is gathered from IS_wrk members at a time by
+#forked processes, as the netCDF library cannot be used from several threads,
+#and the data frames have one column Qout_<i> per member i instead of Qout.
+
+def ens_wrk_ini(IV_tim, IV_col):
+     global IV_tim_wrk, IV_col_wrk
+     IV_tim_wrk=IV_tim
+     IV_col_wrk=IV_col
+
+def ens_wrk_run(rrr_mod_nc):
+     return qout_gather(rrr_mod_nc, IV_tim_wrk, IV_col_wrk)
+
+def pln_smp_ens(YV_mod_nc, YM_pln, IS_wrk=1, IS_row_blk=1000000):
+     for rrr_mod_nc in YV_mod_nc:
+          pln_chk(rrr_mod_nc, YM_pln)
+
+     with rrr_swt_prf_lib.prf_stg('read_qout'):
+          if IS_wrk > 1 and len(YV_mod_nc) > 1                                \
+             and 'fork' in multiprocessing.get_all_start_methods():
+               mp_ctx=multiprocessing.get_context('fork')
+               with mp_ctx.Pool(min(IS_wrk, len(YV_mod_nc)),                   \
+                                initializer=ens_wrk_ini,                       \
+                                initargs=(YM_pln['IV_clo'],                    \
+                                          YM_pln['IV_riv_col'])) as pool:
+                    ZV_qou_all=pool.map(ens_wrk_run, YV_mod_nc, chunksize=1)
+          else:
+               ZV_qou_all=[qout_gather(x, YM_pln['IV_clo'],                    \
+                                       YM_pln['IV_riv_col'])                   \
+                           for x in YV_mod_nc]
+     IS_row_tot=len(YM_pln['IV_clo'])
+     rrr_swt_prf_lib.prf_cnt('read_qout', 'rows', IS_row_tot*len(YV_mod_nc))
+
+     for JS_row_beg in range(0, max(IS_row_tot, 1), IS_row_blk):
+          JS_row_end=min(JS_row_beg+IS_row_blk, IS_row_tot)
+          rrr_ovl_df_qout=pd.DataFrame(                                        \
+                    {'IS_riv_id': YM_pln['IV_riv_id'][JS_row_beg:JS_row_end],  \
+                     'IM_ovl_tim': YM_pln['ZV_tim'][JS_row_beg:JS_row_end],    \
+                     'closest_rrr_time':                                       \
+                                   YM_pln['ZV_clo_tim'][JS_row_beg:JS_row_end],\
+                     'secs_diff': YM_pln['ZV_sec_dif'][JS_row_beg:JS_row_end]},\
+                    index=pd.RangeIndex(JS_row_beg, JS_row_end))
+          for JS_ens,ZV_qou in enumerate(ZV_qou_all):
+               rrr_ovl_df_qout['Qout_'+str(JS_ens)]=ZV_qou[JS_row_beg:JS_row_end]
+          yield rrr_ovl_df_qout
+
+
+#*******************************************************************************
+#Split the overlays into partitions of reaches
+#*******************************************************************************
+#Cuts the reach dimension of Qout into IS_par contiguous ranges with about the
+#same number of overlays each, with limits on chunk boundaries so that no
+#chunk of Qout is read by two partitions. Returns the indices in IV_ovl_id of
+#the overlays of each non-empty partition, in the order of the reach dimension.
+#Overlays of reaches that are not in the model output are dropped.
+
+def par_lim(rrr_mod_nc, IV_ovl_id, IS_par):
+     YS_riv_dim,YS_tim_dim,IV_mod_id,ZV_mod_tim=mod_nc_axes(rrr_mod_nc)
+     with netCDF4.Dataset(rrr_mod_nc, 'r') as rrr_mod_dat:
+          BS_tim_fst,IS_chk_tim,IS_chk_col=qout_chk(rrr_mod_dat.variables['Qout'])
+     IV_ovl_col=riv_col(IV_mod_id, np.asarray(IV_ovl_id, dtype=np.int64))
+     IV_ovl=np.flatnonzero(IV_ovl_col >= 0)
+     IV_ovl=IV_ovl[np.argsort(IV_ovl_col[IV_ovl], kind='stable')]
+     IV_col_srt=IV_ovl_col[IV_ovl]
+
+     IV_lim=IV_col_srt[(np.arange(1, IS_par)*len(IV_col_srt))//IS_par]        \
+            if len(IV_col_srt) > 0 else np.zeros(0, dtype=np.int64)
+     IV_lim=np.unique(np.concatenate(([0], (IV_lim//IS_chk_col)*IS_chk_col,    \
+                                      [len(IV_mod_id)])))
+     IV_cut=np.searchsorted(IV_col_srt, IV_lim[1:-1], side='left')
+     return [np.sort(x) for x in np.split(IV_ovl, IV_cut) if len(x) > 0]
+
+
+#*******************************************************************************
+#Get an executor for the partitions
+#*******************************************************************************
+#Returns an executor with a submit() method whose futures have a result()
+#method: a pool of IS_wrk forked processes for YS_exe='local', or a single
+#thread running the partitions one after the other where processes cannot be
+#forked, or a Dask client for YS_exe='dask', connected to the scheduler at
+#rrr_sch_adr if given, e.g. on several nodes, or to a new cluster of IS_wrk
+#processes on this machine otherwise. Dask is only imported when it is used. As for the process
+#pool, the workers of a local Dask cluster are forked rather than spawned since
+#the scripts run at module level.
+
+YV_exe_all=['local', 'dask']
+#The available executors
+
+def par_exe(YS_exe, IS_wrk=1, rrr_sch_adr=''):
+     if YS_exe == 'local':
+          if 'fork' not in multiprocessing.get_all_start_methods():
+               print('WARNING - Processes cannot be forked, running serially')
+               return concurrent.futures.ThreadPoolExecutor(1)
+          return concurrent.futures.ProcessPoolExecutor(max(IS_wrk, 1),       \
+                                   mp_context=multiprocessing.get_context('fork'))
+     if YS_exe == 'dask':
+          try:
+               import dask.distributed
+          except ImportError:
+               print('ERROR - The dask.distributed module is needed for the dask '\
+                     +'executor')
+               raise SystemExit(22)
+          if rrr_sch_adr != '':
+               return dask.distributed.Client(rrr_sch_adr)
+          dask.config.set({'distributed.worker.multiprocessing-method': 'fork'})
+          return dask.distributed.Client(n_workers=max(IS_wrk, 1),             \
+                                         threads_per_worker=1)
+     print('ERROR - The executor must be one of: '+', '.join(YV_exe_all))
+     raise SystemExit(22)
+
+
+#*******************************************************************************
+#Sample the model output partition by partition
+#*******************************************************************************
+#Runs ovl_smp() on each partition of par_lim() with the executor rrr_exe, each
+#partition writing its own output in a directory next to rrr_out, which must be
+#on a file system shared by all workers. The outputs of the partitions are then
+#concatenated in order into rrr_out, with an index that continues from one
+#partition to the next. The rows are thus grouped by partition, and sorted by
+#time within each. YM_smp_opt holds the keyword arguments of ovl_smp(). Returns
+#the number of rows written.
+
+def par_run(rrr_mod_nc, IV_ovl_id, ZV_ovl_tim, rrr_prt_out, YS_fmt, YM_smp_opt):
+     IS_row_out=0
+     BS_fst=True
+     for rrr_ovl_df_qout in ovl_smp(rrr_mod_nc, IV_ovl_id, ZV_ovl_tim,        \
+                                    **YM_smp_opt):
+          rrr_swt_out_lib.out_write(rrr_prt_out, YS_fmt, rrr_ovl_df_qout, BS_fst)
+          BS_fst=False
+          IS_row_out=IS_row_out+len(rrr_ovl_df_qout)
+     return IS_row_out
+
+def par_smp(rrr_mod_nc, IV_ovl_id, ZV_ovl_tim, rrr_out, YS_fmt, IS_par,      \
+            rrr_exe, YM_smp_opt=None):
+     if YM_smp_opt is None:
+          YM_smp_opt={}
+     IV_ovl_id=np.asarray(IV_ovl_id, dtype=np.int64)
+     ZV_ovl_tim=np.asarray(ZV_ovl_tim, dtype=np.float64)
+     with rrr_swt_prf_lib.prf_stg('split_partitions'):
+          YV_par=par_lim(rrr_mod_nc, IV_ovl_id, IS_par)
+     rrr_swt_prf_lib.prf_cnt('split_partitions', 'partitions', len(YV_par))
+     print('- Number of partitions: '+str(len(YV_par)))
+     if len(YV_par) == 0:
+          YV_par=[np.zeros(0, dtype=np.int64)]
+
+     rrr_prt_dir=rrr_out.rstrip('/\\')+'.parts'
+     if os.path.isdir(rrr_prt_dir):
+          shutil.rmtree(rrr_prt_dir)
+     os.makedirs(rrr_prt_dir)
+     YV_prt=[os.path.join(rrr_prt_dir, 'part-{:05d}'.format(JS_par))          \
+             for JS_par in range(len(YV_par))]
+
+     with rrr_swt_prf_lib.prf_stg('run_partitions'):
+          YV_fut=[rrr_exe.submit(par_run, rrr_mod_nc, IV_ovl_id[IV_par],       \
+                                 ZV_ovl_tim[IV_par], rrr_prt_out, YS_fmt,      \
+                                 YM_smp_opt)                                   \
+                  for IV_par,rrr_prt_out in zip(YV_par, YV_prt)]
+          IS_row_out=sum(x.result() for x in YV_fut)
+     rrr_swt_prf_lib.prf_cnt('run_partitions', 'rows', IS_row_out)
+
+     with rrr_swt_prf_lib.prf_stg('concatenate_partitions'):
+          rrr_swt_out_lib.out_cat(rrr_out, YS_fmt, YV_prt)
+     shutil.rmtree(rrr_prt_dir)
+     return IS_row_out
+
+
+#*******************************************************************************
+#End
+#*******************************************************************************
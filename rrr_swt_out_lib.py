@@ -0,0 +1,370 @@
+#!/usr/bin/python
+#******************************************************************************
+#rrr_swt_out_lib.py
+#******************************************************************************
+#Purpose:
+#Tabular outputs of the SWOT orbit scripts (overlays and sampled discharge),
+#written block by block as CSV, as a CF ragged NetCDF file or as a Parquet
+#dataset, and read back with an optional selection of columns. The discharge of
+#the members of an ensemble is in columns Qout_0, Qout_1, etc., which are
+#stored in NetCDF files as one Qout variable with an 'ensemble' dimension.
+#Authors:
+#Cedric H. David, Etienne Fluet-Chouinard, 2016-2016
+
+
+#*******************************************************************************
+#Import Python modules
+#*******************************************************************************
+import os
+import glob
+import netCDF4
+import numpy as np
+import pandas as pd
+
+
+#*******************************************************************************
+#Declaration of variables
+#*******************************************************************************
+YV_fmt_all=['csv', 'netcdf', 'parquet']
+#The available output formats
+
+YM_col_typ={'IS_riv_id': 'i8',
+            'IM_ovl_tim': 'f8',
+            'closest_rrr_time': 'i4',
+            'secs_diff': 'f4',
+            'Qout': 'f4',
+            'Qout_linear': 'f4',
+            'Qout_mean': 'f4',
+            'Qout_min': 'f4',
+            'Qout_max': 'f4'}
+#The compact data type of each column in NetCDF and Parquet outputs
+
+YM_col_att={'IM_ovl_tim': {'long_name': 'time of SWOT pass relative to '
+                                         'the first model time step',
+                           'units': 'seconds'},
+            'closest_rrr_time': {'long_name': 'closest model time relative to '
+                                              'the first model time step',
+                                 'units': 'seconds'},
+            'secs_diff': {'long_name': 'time difference between SWOT pass '
+                                       'and closest model time',
+                          'units': 'seconds'},
+            'Qout': {'long_name': 'average river water discharge downstream '
+                                  'of each river reach',
+                     'units': 'm3 s-1',
+                     'coordinates': 'rivid time'},
+            'Qout_linear': {'long_name': 'river water discharge linearly '
+                                         'interpolated at the time of SWOT pass',
+                            'units': 'm3 s-1'},
+            'Qout_mean': {'long_name': 'mean river water discharge within the '
+                                       'window around the time of SWOT pass',
+                          'units': 'm3 s-1'},
+            'Qout_min': {'long_name': 'minimum river water discharge within '
+                                      'the window around the time of SWOT pass',
+                         'units': 'm3 s-1'},
+            'Qout_max': {'long_name': 'maximum river water discharge within '
+                                      'the window around the time of SWOT pass',
+                         'units': 'm3 s-1'}}
+#The attributes of each column in NetCDF outputs. The times are durations
+#since the first model time step, whose date is not known in general, so that
+#they are not CF time coordinates
+
+YM_col_var={'IM_ovl_tim': 'time'}
+#The NetCDF variable of the columns that are not stored under their own name
+
+YS_ens_pfx='Qout_'
+#The prefix of the discharge column of each member of an ensemble
+
+
+#*******************************************************************************
+#Determine the kind and data type of a column
+#*******************************************************************************
+#col_ens() tells if YS_col is the column of an ensemble member. col_typ()
+#returns the compact data type of the column YS_col, that of Qout for the
+#columns of ensemble members, and 'f8' for unknown columns.
+
+def col_ens(YS_col):
+     return YS_col.startswith(YS_ens_pfx) and YS_col[len(YS_ens_pfx):].isdigit()
+
+def col_typ(YS_col):
+     if col_ens(YS_col):
+          YS_col='Qout'
+     return YM_col_typ.get(YS_col, 'f8')
+
+
+#*******************************************************************************
+#Convert a column to its data type
+#*******************************************************************************
+#Returns the values of the column YS_col of rrr_out_df in its compact data type,
+#and stops if integer values do not fit in that type rather than wrapping them.
+
+def col_val(rrr_out_df, YS_col):
+     YS_typ=col_typ(YS_col)
+     ZV_val=rrr_out_df[YS_col].values
+     if np.dtype(YS_typ).kind == 'i' and len(ZV_val) > 0:
+          rrr_typ_inf=np.iinfo(YS_typ)
+          if np.min(ZV_val) < rrr_typ_inf.min                                  \
+             or np.max(ZV_val) > rrr_typ_inf.max:
+               print('ERROR - The values of '+YS_col+' do not fit in the data '\
+                     +'type '+YS_typ+' of NetCDF and Parquet outputs')
+               raise SystemExit(22)
+     return ZV_val.astype(YS_typ)
+
+
+#*******************************************************************************
+#Determine the format of an output file
+#*******************************************************************************
+#Returns YS_fmt if given, otherwise guesses the format from the extension of
+#rrr_out: '.nc' for NetCDF, '.parquet' for Parquet and CSV for anything else.
+
+def out_fmt(rrr_out, YS_fmt=None):
+     if YS_fmt is None or YS_fmt == '':
+          YS_ext=os.path.splitext(rrr_out)[1].lower()
+          if YS_ext in ['.nc', '.nc4']:
+               YS_fmt='netcdf'
+          elif YS_ext in ['.parquet', '.pq']:
+               YS_fmt='parquet'
+          else:
+               YS_fmt='csv'
+     if YS_fmt not in YV_fmt_all:
+          print('ERROR - The output format must be one of: '+', '.join(YV_fmt_all))
+          raise SystemExit(22)
+     return YS_fmt
+
+
+#*******************************************************************************
+#Write one block of an output
+#*******************************************************************************
+#Writes the data frame rrr_out_df to rrr_out, creating the file if BS_fst is
+#True and appending to it otherwise. The index of the data frame is only kept
+#in CSV files.
+#- In NetCDF files, the rows are stored along an unlimited 'obs' dimension as
+#  an indexed ragged array, laid out as in CF discrete sampling geometries:
+#  each row points with 'rivid_index' to its river reach along the unlimited
+#  'rivid' dimension, which grows as new reaches are found in later blocks. As
+#  the times are not CF time coordinates, no featureType is declared.
+#  The columns of ensemble members are stored in Qout along an additional
+#  'ensemble' dimension, with the names YV_ens of the members if given.
+#- Parquet outputs are a directory in which each block is one file, so that
+#  no block has to be kept open between calls.
+
+def out_write(rrr_out, YS_fmt, rrr_out_df, BS_fst, YV_ens=None):
+     if YS_fmt == 'csv':
+          rrr_out_df.to_csv(rrr_out, mode='w' if BS_fst else 'a', header=BS_fst)
+     elif YS_fmt == 'netcdf':
+          out_write_nc(rrr_out, rrr_out_df, BS_fst, YV_ens)
+     elif YS_fmt == 'parquet':
+          out_write_pq(rrr_out, rrr_out_df, BS_fst)
+
+def out_write_nc(rrr_out, rrr_out_df, BS_fst, YV_ens=None):
+     YV_ens_col=[x for x in rrr_out_df.columns if col_ens(x)]
+     YV_col=[x for x in rrr_out_df.columns                                     \
+             if x != 'IS_riv_id' and x not in YV_ens_col]
+     if BS_fst:
+          rrr_out_dat=netCDF4.Dataset(rrr_out, 'w', format='NETCDF4')
+          rrr_out_dat.createDimension('rivid', None)
+          rrr_out_dat.createDimension('obs', None)
+          rrr_riv_var=rrr_out_dat.createVariable('rivid', col_typ('IS_riv_id'),\
+                                                 ('rivid',))
+          rrr_riv_var.long_name='unique identifier for each river reach'
+          rrr_riv_var.cf_role='timeseries_id'
+          rrr_idx_var=rrr_out_dat.createVariable('rivid_index', 'i4', ('obs',))
+          rrr_idx_var.long_name='index of the river reach of each observation'
+          rrr_idx_var.instance_dimension='rivid'
+          for YS_col in YV_col:
+               rrr_col_var=rrr_out_dat.createVariable(                         \
+                                   YM_col_var.get(YS_col, YS_col),             \
+                                   YM_col_typ.get(YS_col, 'f8'), ('obs',),     \
+                                   zlib=True, chunksizes=(65536,))
+               rrr_col_var.setncatts(YM_col_att.get(YS_col, {}))
+          if len(YV_ens_col) > 0:
+               rrr_out_dat.createDimension('ensemble', len(YV_ens_col))
+               if YV_ens is not None:
+                    rrr_ens_var=rrr_out_dat.createVariable('ensemble_member',  \
+                                                           str, ('ensemble',))
+                    rrr_ens_var.long_name='model output of each ensemble member'
+                    rrr_ens_var[:]=np.array(YV_ens, dtype=object)
+               rrr_qou_var=rrr_out_dat.createVariable('Qout', col_typ('Qout'), \
+                                   ('obs', 'ensemble'), zlib=True,             \
+                                   chunksizes=(65536, 1))
+               rrr_qou_var.setncatts(YM_col_att['Qout'])
+          rrr_out_dat.Conventions='CF-1.6'
+     else:
+          rrr_out_dat=netCDF4.Dataset(rrr_out, 'a')
+
+     with rrr_out_dat:
+          IV_riv_old=rrr_out_dat.variables['rivid'][:].astype(np.int64)
+          IV_riv_id=col_val(rrr_out_df, 'IS_riv_id')
+          IV_riv_new=np.setdiff1d(np.unique(IV_riv_id), IV_riv_old)
+          IV_riv_all=np.concatenate((IV_riv_old, IV_riv_new))
+          rrr_out_dat.variables['rivid'][len(IV_riv_old):]=IV_riv_new
+
+          IV_all_srt=np.argsort(IV_riv_all, kind='stable')
+          IV_idx=IV_all_srt[np.searchsorted(IV_riv_all[IV_all_srt], IV_riv_id)]
+
+          IS_obs_beg=len(rrr_out_dat.dimensions['obs'])
+          IS_obs_end=IS_obs_beg+len(rrr_out_df)
+          rrr_out_dat.variables['rivid_index'][IS_obs_beg:IS_obs_end]=IV_idx
+          for YS_col in YV_col:
+               YS_var=YM_col_var.get(YS_col, YS_col)
+               rrr_out_dat.variables[YS_var][IS_obs_beg:IS_obs_end]=          \
+                      col_val(rrr_out_df, YS_col)
+          if len(YV_ens_col) > 0:
+               rrr_out_dat.variables['Qout'][IS_obs_beg:IS_obs_end, :]=        \
+                      rrr_out_df[YV_ens_col].values.astype(col_typ('Qout'))
+
+def out_write_pq(rrr_out, rrr_out_df, BS_fst):
+     try:
+          import pyarrow
+          import pyarrow.parquet
+     except ImportError:
+          print('ERROR - The pyarrow module is needed for Parquet outputs')
+          raise SystemExit(22)
+     if BS_fst:
+          if not os.path.isdir(rrr_out):
+               os.makedirs(rrr_out)
+          for rrr_prt in glob.glob(os.path.join(rrr_out, 'part-*.parquet')):
+               os.remove(rrr_prt)
+     IS_prt=len(glob.glob(os.path.join(rrr_out, 'part-*.parquet')))
+     rrr_out_tab=pyarrow.Table.from_pandas(                                   \
+                 pd.DataFrame(dict((x, col_val(rrr_out_df, x))                 \
+                                   for x in rrr_out_df.columns)),              \
+                 preserve_index=False)
+     pyarrow.parquet.write_table(rrr_out_tab,                                  \
+                 os.path.join(rrr_out, 'part-{:05d}.parquet'.format(IS_prt)))
+
+
+#*******************************************************************************
+#Read an output
+#*******************************************************************************
+#Reads a CSV, NetCDF or Parquet output written by out_write() into a data frame
+#with one row per observation. Only the columns in YV_col are read if given,
+#where Qout stands for all the ensemble members of an ensemble output.
+
+def col_sel(YV_col, YV_col_all):
+     YV_col_sel=[]
+     for YS_col in YV_col:
+          YV_ens_col=[x for x in YV_col_all if YS_col == 'Qout' and col_ens(x)]
+          YV_col_sel+=YV_ens_col if len(YV_ens_col) > 0 else [YS_col]
+     return YV_col_sel
+
+def out_read(rrr_out, YS_fmt=None, YV_col=None):
+     YS_fmt=out_fmt(rrr_out, YS_fmt)
+     if YS_fmt == 'csv':
+          if YV_col is not None:
+               YV_col=col_sel(YV_col, pd.read_csv(rrr_out, nrows=0).columns)
+          rrr_out_df=pd.read_csv(rrr_out, usecols=YV_col)
+          return rrr_out_df.drop(columns=[x for x in rrr_out_df.columns        \
+                                          if x.startswith('Unnamed')])
+     if YS_fmt == 'parquet':
+          try:
+               import pyarrow.parquet
+          except ImportError:
+               print('ERROR - The pyarrow module is needed for Parquet outputs')
+               raise SystemExit(22)
+          rrr_prt=sorted(glob.glob(os.path.join(rrr_out, 'part-*.parquet')))
+          if YV_col is not None and len(rrr_prt) > 0:
+               YV_col=col_sel(YV_col,                                          \
+                              pyarrow.parquet.read_schema(rrr_prt[0]).names)
+          return pd.concat([pyarrow.parquet.read_table(x, columns=YV_col)      \
+                            .to_pandas() for x in rrr_prt], ignore_index=True)
+
+     YM_var_col=dict((y, x) for x, y in YM_col_var.items())
+     with netCDF4.Dataset(rrr_out, 'r') as rrr_out_dat:
+          rrr_out_dat.set_auto_mask(False)
+          if YV_col is None:
+               YV_col=['IS_riv_id']+[YM_var_col.get(x, x)                      \
+                                     for x in rrr_out_dat.variables            \
+                                     if x not in ['rivid', 'rivid_index']      \
+                                     and rrr_out_dat.variables[x]              \
+                                         .dimensions[0] == 'obs']
+          rrr_out_df=pd.DataFrame()
+          for YS_col in YV_col:
+               if YS_col == 'IS_riv_id':
+                    IV_riv_id=rrr_out_dat.variables['rivid'][:]
+                    IV_idx=rrr_out_dat.variables['rivid_index'][:]
+                    rrr_out_df[YS_col]=IV_riv_id[IV_idx]
+               elif YS_col == 'Qout' and                                       \
+                    rrr_out_dat.variables['Qout'].ndim == 2:
+                    ZM_qou=rrr_out_dat.variables['Qout'][:]
+                    for JS_ens in range(ZM_qou.shape[1]):
+                         rrr_out_df[YS_ens_pfx+str(JS_ens)]=ZM_qou[:, JS_ens]
+               else:
+                    YS_var=YM_col_var.get(YS_col, YS_col)
+                    rrr_out_df[YS_col]=rrr_out_dat.variables[YS_var][:]
+     return rrr_out_df
+
+
+#*******************************************************************************
+#Measure and truncate an output
+#*******************************************************************************
+#out_size() returns the size of rrr_out in its own unit: bytes for CSV files,
+#observations for NetCDF files and blocks for Parquet datasets. out_trunc()
+#truncates rrr_out back to the size IS_siz given by an earlier call to
+#out_size(), e.g. to drop the blocks written after a checkpoint. NetCDF files
+#cannot shrink and are rewritten.
+
+def out_size(rrr_out, YS_fmt):
+     if YS_fmt == 'csv':
+          return os.path.getsize(rrr_out)
+     if YS_fmt == 'parquet':
+          return len(glob.glob(os.path.join(rrr_out, 'part-*.parquet')))
+     with netCDF4.Dataset(rrr_out, 'r') as rrr_out_dat:
+          return len(rrr_out_dat.dimensions['obs'])
+
+def out_trunc(rrr_out, YS_fmt, IS_siz):
+     if out_size(rrr_out, YS_fmt) <= IS_siz:
+          return
+     if YS_fmt == 'csv':
+          with open(rrr_out, 'r+b') as csvfile:
+               csvfile.truncate(IS_siz)
+     elif YS_fmt == 'parquet':
+          rrr_prt=sorted(glob.glob(os.path.join(rrr_out, 'part-*.parquet')))
+          for rrr_prt_xtr in rrr_prt[IS_siz:]:
+               os.remove(rrr_prt_xtr)
+     else:
+          rrr_out_df=out_read(rrr_out, YS_fmt).iloc[:IS_siz]
+          out_write_nc(rrr_out, rrr_out_df, True)
+
+
+#*******************************************************************************
+#Concatenate outputs
+#*******************************************************************************
+#Concatenates the outputs YV_prt, in order, into rrr_out. The index of CSV
+#files is renumbered so that it continues from one output to the next, the
+#blocks of Parquet datasets are moved and renumbered, and the rows of NetCDF
+#files are appended one output at a time.
+
+def out_cat(rrr_out, YS_fmt, YV_prt):
+     if YS_fmt == 'csv':
+          IS_row_out=0
+          with open(rrr_out, 'w', newline='') as csvfile:
+               for JS_prt in range(len(YV_prt)):
+                    with open(YV_prt[JS_prt], 'r', newline='') as csvfile_prt:
+                         YS_hdr=csvfile_prt.readline()
+                         if JS_prt == 0:
+                              csvfile.write(YS_hdr)
+                         for YS_lin in csvfile_prt:
+                              csvfile.write(str(IS_row_out)                    \
+                                            +YS_lin[YS_lin.index(','):])
+                              IS_row_out=IS_row_out+1
+     elif YS_fmt == 'parquet':
+          if not os.path.isdir(rrr_out):
+               os.makedirs(rrr_out)
+          for rrr_prt in glob.glob(os.path.join(rrr_out, 'part-*.parquet')):
+               os.remove(rrr_prt)
+          IS_prt=0
+          for rrr_prt_dir in YV_prt:
+               for rrr_prt in sorted(glob.glob(os.path.join(rrr_prt_dir,       \
+                                                            'part-*.parquet'))):
+                    os.replace(rrr_prt, os.path.join(rrr_out,                  \
+                               'part-{:05d}.parquet'.format(IS_prt)))
+                    IS_prt=IS_prt+1
+     else:
+          for JS_prt in range(len(YV_prt)):
+               out_write_nc(rrr_out, out_read(YV_prt[JS_prt], YS_fmt),         \
+                            JS_prt == 0)
+
+
+#*******************************************************************************
+#End
+#*******************************************************************************
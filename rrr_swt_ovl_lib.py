@@ -0,0 +1,701 @@
+#!/usr/bin/python
+#******************************************************************************
+#rrr_swt_ovl_lib.py
+#******************************************************************************
+#Purpose:
+#Overlay engine shared by the SWOT orbit scripts. Each river and orbit geometry
+#is decoded once into an in-memory array, the river geometries are bulk-loaded
+#into a Sort-Tile-Recursive tree, each orbit polygon is prepared, and the
+#containment tests for the whole orbit layer are run in one vectorized query.
+#Authors:
+#Cedric H. David, Etienne Fluet-Chouinard, 2016-2016
+
+
+#*******************************************************************************
+#Import Python modules
+#*******************************************************************************
+import os
+import json
+import hashlib
+import tempfile
+import multiprocessing
+import fiona
+import numpy as np
+import shapely
+import shapely.geometry
+
+
+#*******************************************************************************
+#Read a river shapefile
+#*******************************************************************************
+#Reads all river features sequentially and returns the name of the river ID
+#attribute ('COMID' or 'ARCID'), an array with the river IDs and an array with
+#the decoded river geometries, both in the order of the shapefile.
+
+def riv_id_nam(rrr_riv_lay, rrr_riv_shp):
+     YV_riv_prp=rrr_riv_lay.schema['properties']
+     if 'COMID' in YV_riv_prp:
+          return 'COMID'
+     elif 'ARCID' in YV_riv_prp:
+          return 'ARCID'
+     print('ERROR - Neither COMID nor ARCID exist in '+rrr_riv_shp)
+     raise SystemExit(22)
+
+def riv_shp_read(rrr_riv_shp):
+     with fiona.open(rrr_riv_shp, 'r') as rrr_riv_lay:
+          YV_riv_id=riv_id_nam(rrr_riv_lay, rrr_riv_shp)
+
+          IV_riv_tot_id=[]
+          riv_geo=[]
+          for rrr_riv_feat in rrr_riv_lay:
+               IV_riv_tot_id.append(int(rrr_riv_feat['properties'][YV_riv_id]))
+               riv_geo.append(shapely.geometry.shape(rrr_riv_feat['geometry']))
+
+     IV_riv_tot_id=np.array(IV_riv_tot_id, dtype=np.int64)
+     riv_geo=np.array(riv_geo, dtype=object)
+     return YV_riv_id, IV_riv_tot_id, riv_geo
+
+
+#*******************************************************************************
+#Read a river shapefile through an on-disk cache
+#*******************************************************************************
+#The decoded river geometries are stored in rrr_cch_dir as WKB concatenated in
+#one memory-mapped file with an array of offsets, next to the river IDs. The
+#STRtree is not stored: bulk-loading it from the decoded geometries costs far
+#less than parsing the shapefile. The cache is keyed by the absolute path of the
+#shapefile and checked against the size and modification time of its .shp and
+#.dbf files, so that a changed input rebuilds the cache automatically. Returns
+#the same values as riv_shp_read().
+
+IS_cch_ver=1
+#Version of the cache layout, bumped whenever the layout changes
+
+def shp_sig(rrr_shp):
+     YS_shp_abs=os.path.abspath(rrr_shp)
+     YM_sig={'path': YS_shp_abs, 'version': IS_cch_ver}
+     for YS_ext in ['.shp', '.dbf']:
+          YS_fil=os.path.splitext(YS_shp_abs)[0]+YS_ext
+          if os.path.isfile(YS_fil):
+               rrr_sta=os.stat(YS_fil)
+               YM_sig[YS_ext]=[rrr_sta.st_size, rrr_sta.st_mtime_ns]
+     return YM_sig
+
+def riv_shp_read_cch(rrr_riv_shp, rrr_cch_dir):
+     YM_sig=shp_sig(rrr_riv_shp)
+     YS_key=hashlib.sha1(YM_sig['path'].encode('utf-8')).hexdigest()
+     rrr_cch=os.path.join(rrr_cch_dir, YS_key)
+     rrr_cch_sig=os.path.join(rrr_cch, 'riv_sig.json')
+
+     if os.path.isfile(rrr_cch_sig):
+          with open(rrr_cch_sig, 'r') as jsonfile:
+               YM_cch_sig=json.load(jsonfile)
+          if YM_cch_sig['signature'] == YM_sig:
+               print('- Reading river features from cache: '+rrr_cch)
+               YV_riv_id=YM_cch_sig['YV_riv_id']
+               IV_riv_tot_id=np.load(os.path.join(rrr_cch, 'riv_id.npy'))
+               IV_riv_off=np.load(os.path.join(rrr_cch, 'riv_off.npy'))
+               IV_riv_wkb=np.load(os.path.join(rrr_cch, 'riv_wkb.npy'),       \
+                                  mmap_mode='r')
+               riv_wkb=[IV_riv_wkb[IV_riv_off[JS]:IV_riv_off[JS+1]].tobytes() \
+                        for JS in range(len(IV_riv_tot_id))]
+               riv_geo=shapely.from_wkb(riv_wkb)
+               return YV_riv_id, IV_riv_tot_id, riv_geo
+          print('- River shapefile changed, rebuilding cache: '+rrr_cch)
+          os.remove(rrr_cch_sig)
+     else:
+          print('- Building cache: '+rrr_cch)
+
+     YV_riv_id,IV_riv_tot_id,riv_geo=riv_shp_read(rrr_riv_shp)
+
+     riv_wkb=shapely.to_wkb(riv_geo)
+     IV_riv_off=np.zeros(len(riv_wkb)+1, dtype=np.int64)
+     IV_riv_off[1:]=np.cumsum([len(x) for x in riv_wkb])
+     IV_riv_wkb=np.frombuffer(b''.join(riv_wkb), dtype=np.uint8)
+
+     if not os.path.isdir(rrr_cch):
+          os.makedirs(rrr_cch)
+     np.save(os.path.join(rrr_cch, 'riv_id.npy'), IV_riv_tot_id)
+     np.save(os.path.join(rrr_cch, 'riv_off.npy'), IV_riv_off)
+     np.save(os.path.join(rrr_cch, 'riv_wkb.npy'), IV_riv_wkb)
+     #The signature is written last so that an interrupted write is never
+     #mistaken for a valid cache
+     with open(rrr_cch_sig, 'w') as jsonfile:
+          json.dump({'signature': YM_sig, 'YV_riv_id': YV_riv_id}, jsonfile)
+
+     return YV_riv_id, IV_riv_tot_id, riv_geo
+
+
+#*******************************************************************************
+#Read an orbit shapefile
+#*******************************************************************************
+#Reads all orbit features sequentially and returns an array with the
+#'Mean_time' of each orbit pass and an array with the decoded orbit geometries,
+#both in the order of the shapefile.
+
+def orb_shp_read(rrr_orb_shp):
+     with fiona.open(rrr_orb_shp, 'r') as rrr_orb_lay:
+          ZV_orb_tim=[]
+          orb_geo=[]
+          for rrr_orb_feat in rrr_orb_lay:
+               ZV_orb_tim.append(float(rrr_orb_feat['properties']['Mean_time']))
+               orb_geo.append(shapely.geometry.shape(rrr_orb_feat['geometry']))
+
+     ZV_orb_tim=np.array(ZV_orb_tim, dtype=np.float64)
+     orb_geo=np.array(orb_geo, dtype=object)
+     return ZV_orb_tim, orb_geo
+
+
+#*******************************************************************************
+#Split an orbit feature into compact segments
+#*******************************************************************************
+#SWOT swaths are long and narrow, often diagonal, so that their bounds cover
+#far more river features than they contain. The orbit feature is cut across its
+#longest side into bands about ZS_seg_wid times as long as the swath is wide,
+#and the extent of the feature across each band boundary is found from the
+#edges of its rings, each edge only being evaluated at the band boundaries it
+#crosses. Returns the axis along which the bands are cut (0 for x and 1 for y),
+#the band boundaries ZV_cut along that axis, the bounds of the feature within
+#each band as boxes, and for each band the extent across the axis of an inner
+#rectangle spanning the band, with BV_inn telling for which bands that
+#rectangle is verified to be within the interior of the feature.
+
+def orb_seg(orb_shy, ZS_seg_wid=0.5):
+     ZV_bnd=np.array(orb_shy.bounds)
+     IS_axi=0 if ZV_bnd[2]-ZV_bnd[0] > ZV_bnd[3]-ZV_bnd[1] else 1
+     IS_crs=1-IS_axi
+     ZS_wid=orb_shy.area/max(np.hypot(ZV_bnd[2]-ZV_bnd[0],                     \
+                                      ZV_bnd[3]-ZV_bnd[1]), 1e-300)
+     ZS_bnd=(ZV_bnd[2+IS_axi]-ZV_bnd[IS_axi])/max(ZS_wid*ZS_seg_wid, 1e-300)
+     IS_bnd=int(min(max(np.ceil(ZS_bnd), 1), 4096)) if ZS_wid > 0 else 1
+     ZV_cut=np.linspace(ZV_bnd[IS_axi], ZV_bnd[2+IS_axi], IS_bnd+1)
+
+     #--------------------------------------------------------------------------
+     #Extent of the feature across each band boundary
+     #--------------------------------------------------------------------------
+     ZM_crd=[shapely.get_coordinates(x)                                        \
+             for x in shapely.get_rings(shapely.get_parts(orb_shy))]
+     ZM_beg=np.concatenate([x[:-1] for x in ZM_crd])
+     ZM_end=np.concatenate([x[1:] for x in ZM_crd])
+     IV_cut_beg=np.searchsorted(ZV_cut, np.minimum(ZM_beg[:, IS_axi],          \
+                                ZM_end[:, IS_axi]), side='left')
+     IV_cut_cnt=np.searchsorted(ZV_cut, np.maximum(ZM_beg[:, IS_axi],          \
+                                ZM_end[:, IS_axi]), side='right')-IV_cut_beg
+     IV_crs_edg=np.repeat(np.arange(len(ZM_beg)), IV_cut_cnt)
+     IV_crs_cut=IV_cut_beg[IV_crs_edg]+np.arange(len(IV_crs_edg))              \
+               -np.repeat(np.cumsum(IV_cut_cnt)-IV_cut_cnt, IV_cut_cnt)
+     ZV_a00=ZM_beg[IV_crs_edg, IS_axi]
+     ZV_a01=ZM_end[IV_crs_edg, IS_axi]
+     ZV_c00=ZM_beg[IV_crs_edg, IS_crs]
+     ZV_c01=ZM_end[IV_crs_edg, IS_crs]
+     with np.errstate(divide='ignore', invalid='ignore'):
+          ZV_crs=ZV_c00+(ZV_c01-ZV_c00)*(ZV_cut[IV_crs_cut]-ZV_a00)            \
+                 /(ZV_a01-ZV_a00)
+     BV_flt=ZV_a01 == ZV_a00
+     ZV_cut_min=np.full(len(ZV_cut), np.inf)
+     ZV_cut_max=np.full(len(ZV_cut), -np.inf)
+     np.minimum.at(ZV_cut_min, IV_crs_cut,                                     \
+                   np.where(BV_flt, np.minimum(ZV_c00, ZV_c01), ZV_crs))
+     np.maximum.at(ZV_cut_max, IV_crs_cut,                                     \
+                   np.where(BV_flt, np.maximum(ZV_c00, ZV_c01), ZV_crs))
+
+     #--------------------------------------------------------------------------
+     #Bounds of the feature within each band, including the vertices inside
+     #--------------------------------------------------------------------------
+     ZV_seg_min=np.minimum(ZV_cut_min[:-1], ZV_cut_min[1:])
+     ZV_seg_max=np.maximum(ZV_cut_max[:-1], ZV_cut_max[1:])
+     IV_bnd=np.clip(np.searchsorted(ZV_cut, ZM_beg[:, IS_axi], side='right')-1,\
+                    0, IS_bnd-1)
+     np.minimum.at(ZV_seg_min, IV_bnd, ZM_beg[:, IS_crs])
+     np.maximum.at(ZV_seg_max, IV_bnd, ZM_beg[:, IS_crs])
+     BV_seg=np.isfinite(ZV_seg_min) & np.isfinite(ZV_seg_max)
+
+     #--------------------------------------------------------------------------
+     #Inner rectangles, slightly shrunk and verified
+     #--------------------------------------------------------------------------
+     ZV_inn_min=np.maximum(ZV_cut_min[:-1], ZV_cut_min[1:])
+     ZV_inn_max=np.minimum(ZV_cut_max[:-1], ZV_cut_max[1:])
+     with np.errstate(invalid='ignore'):
+          ZV_inn_mar=(ZV_inn_max-ZV_inn_min)*0.01
+          ZV_inn_min=ZV_inn_min+ZV_inn_mar
+          ZV_inn_max=ZV_inn_max-ZV_inn_mar
+     BV_inn=np.isfinite(ZV_inn_min) & np.isfinite(ZV_inn_max)                  \
+           & (ZV_inn_min < ZV_inn_max)
+     IV_inn=np.flatnonzero(BV_inn)
+     BV_inn[IV_inn]=shapely.contains_properly(orb_shy,                         \
+                    seg_box(IS_axi, ZV_cut[IV_inn], ZV_cut[IV_inn+1],          \
+                            ZV_inn_min[IV_inn], ZV_inn_max[IV_inn]))
+
+     seg_geo=seg_box(IS_axi, ZV_cut[:-1][BV_seg], ZV_cut[1:][BV_seg],          \
+                     ZV_seg_min[BV_seg], ZV_seg_max[BV_seg])
+     return IS_axi, ZV_cut, seg_geo, ZV_inn_min, ZV_inn_max, BV_inn
+
+def seg_box(IS_axi, ZV_axi_min, ZV_axi_max, ZV_crs_min, ZV_crs_max):
+     if IS_axi == 0:
+          return shapely.box(ZV_axi_min, ZV_crs_min, ZV_axi_max, ZV_crs_max)
+     return shapely.box(ZV_crs_min, ZV_axi_min, ZV_crs_max, ZV_axi_max)
+
+
+#*******************************************************************************
+#Find the candidate river features of an orbit feature
+#*******************************************************************************
+#Queries the river tree with the segments of the orbit feature rather than with
+#its bounds. Returns the candidate river features, and tells which of them are
+#accepted without the exact test because their bounds lie within the inner
+#rectangle of a single band. Features of other geometry types than polygons
+#fall back to a query with their bounds.
+
+def orb_cnd(riv_tre, ZM_riv_bnd, orb_shy):
+     if shapely.is_empty(orb_shy) or                                           \
+        shapely.get_type_id(orb_shy) not in [3, 6]:
+          IV_cnd=riv_tre.query(orb_shy)
+          return IV_cnd, np.zeros(len(IV_cnd), dtype=bool)
+
+     IS_axi,ZV_cut,seg_geo,ZV_inn_min,ZV_inn_max,BV_inn=orb_seg(orb_shy)
+     IV_cnd=np.unique(riv_tre.query(seg_geo)[1])
+     ZM_cnd_bnd=ZM_riv_bnd[IV_cnd]
+     IV_bnd_beg=np.searchsorted(ZV_cut, ZM_cnd_bnd[:, IS_axi], side='right')-1
+     IV_bnd_end=np.searchsorted(ZV_cut, ZM_cnd_bnd[:, 2+IS_axi], side='left')-1
+     IV_bnd=np.clip(IV_bnd_beg, 0, len(ZV_cut)-2)
+     BV_acc=(IV_bnd_beg == IV_bnd_end) & (IV_bnd_beg >= 0)                     \
+           & (IV_bnd_beg < len(ZV_cut)-1) & BV_inn[IV_bnd]                     \
+           & (ZM_cnd_bnd[:, 1-IS_axi] >= ZV_inn_min[IV_bnd])                   \
+           & (ZM_cnd_bnd[:, 3-IS_axi] <= ZV_inn_max[IV_bnd])
+     return IV_cnd, BV_acc
+
+
+#*******************************************************************************
+#Find river features completely contained in orbit features
+#*******************************************************************************
+#Coarse-to-fine search: the orbit features whose bounds do not intersect the
+#bounds of the river network are skipped, the river tree is queried with the
+#compact segments of each remaining orbit feature (see orb_cnd()), candidates
+#within an inner rectangle are accepted directly, and the 'contains' predicate
+#is only evaluated against the prepared orbit polygon for the other candidates.
+#Returns the index of the orbit feature and of the river feature for each
+#overlay, sorted by orbit feature and then by river feature, which is the order
+#in which a loop over the orbit layer would find them, and, for each orbit
+#feature, the number of candidate river features found by the segment query
+#and the number of them that needed the exact test.
+
+def ovl_riv_orb(riv_geo, orb_geo):
+     riv_tre=shapely.STRtree(riv_geo)
+     return ovl_tre_orb(riv_tre, orb_geo)
+
+def ovl_tre_orb(riv_tre, orb_geo):
+     riv_geo=riv_tre.geometries
+     ZM_riv_bnd=shapely.bounds(riv_geo)
+     IV_ovl_orb=[np.zeros(0, dtype=np.int64)]
+     IV_ovl_riv=[np.zeros(0, dtype=np.int64)]
+     IV_cnd_cnt=np.zeros(len(orb_geo), dtype=np.int64)
+     IV_tst_cnt=np.zeros(len(orb_geo), dtype=np.int64)
+     for JS_orb in ovl_orb_net(riv_geo, orb_geo):
+          orb_shy=orb_geo[JS_orb]
+          shapely.prepare(orb_shy)
+          IV_cnd,BV_acc=orb_cnd(riv_tre, ZM_riv_bnd, orb_shy)
+          IV_tst=IV_cnd[~BV_acc]
+          IV_riv=np.sort(np.concatenate((IV_cnd[BV_acc],                       \
+                         IV_tst[shapely.contains(orb_shy, riv_geo[IV_tst])])))
+          IV_ovl_orb.append(np.full(len(IV_riv), JS_orb, dtype=np.int64))
+          IV_ovl_riv.append(IV_riv.astype(np.int64))
+          IV_cnd_cnt[JS_orb]=len(IV_cnd)
+          IV_tst_cnt[JS_orb]=len(IV_tst)
+     return np.concatenate(IV_ovl_orb), np.concatenate(IV_ovl_riv),           \
+            IV_cnd_cnt, IV_tst_cnt
+
+def ovl_orb_net(riv_geo, orb_geo):
+     if len(riv_geo) == 0 or len(orb_geo) == 0:
+          return np.zeros(0, dtype=np.int64)
+     ZV_net_bnd=shapely.total_bounds(riv_geo)
+     ZM_orb_bnd=shapely.bounds(orb_geo)
+     return np.flatnonzero((ZM_orb_bnd[:, 0] <= ZV_net_bnd[2])                 \
+                         & (ZM_orb_bnd[:, 2] >= ZV_net_bnd[0])                 \
+                         & (ZM_orb_bnd[:, 1] <= ZV_net_bnd[3])                 \
+                         & (ZM_orb_bnd[:, 3] >= ZV_net_bnd[1]))
+
+
+#*******************************************************************************
+#Find river features completely contained in orbit features, in parallel
+#*******************************************************************************
+#The orbit features are split into contiguous blocks that are distributed over
+#a pool of IS_wrk processes. Each worker rebuilds the river tree once from the
+#WKB of the river geometries, and the overlays of each block are concatenated
+#in block order so that the result is identical to that of ovl_riv_orb().
+#The scripts run at module level, so workers are forked rather than spawned;
+#the overlay is done serially where fork is not available.
+
+riv_tre_wrk=None
+#The river tree of the current worker process
+
+def ovl_wrk_ini(riv_wkb):
+     global riv_tre_wrk
+     riv_tre_wrk=shapely.STRtree(shapely.from_wkb(riv_wkb))
+
+def ovl_wrk_run(IS_orb_off, orb_wkb):
+     IV_ovl_orb,IV_ovl_riv,IV_cnd_cnt,IV_tst_cnt=ovl_tre_orb(riv_tre_wrk,      \
+                                                shapely.from_wkb(orb_wkb))
+     return IV_ovl_orb+IS_orb_off, IV_ovl_riv, IV_cnd_cnt, IV_tst_cnt
+
+def ovl_riv_orb_par(riv_geo, orb_geo, IS_wrk, IS_blk_per_wrk=4):
+     if IS_wrk <= 1 or len(orb_geo) <= 1:
+          return ovl_riv_orb(riv_geo, orb_geo)
+     if 'fork' not in multiprocessing.get_all_start_methods():
+          print('WARNING - Processes cannot be forked, running serially')
+          return ovl_riv_orb(riv_geo, orb_geo)
+
+     IV_orb_blk=np.array_split(np.arange(len(orb_geo)), IS_wrk*IS_blk_per_wrk)
+     YV_blk_arg=[(int(IV_orb[0]), shapely.to_wkb(orb_geo[IV_orb]))           \
+                 for IV_orb in IV_orb_blk if len(IV_orb) > 0]
+
+     mp_ctx=multiprocessing.get_context('fork')
+     with mp_ctx.Pool(IS_wrk, initializer=ovl_wrk_ini,                        \
+                      initargs=(shapely.to_wkb(riv_geo),)) as pool:
+          YV_blk_res=pool.starmap(ovl_wrk_run, YV_blk_arg)
+
+     IV_ovl_orb=np.concatenate([x[0] for x in YV_blk_res])
+     IV_ovl_riv=np.concatenate([x[1] for x in YV_blk_res])
+     IV_cnd_cnt=np.concatenate([x[2] for x in YV_blk_res])
+     IV_tst_cnt=np.concatenate([x[3] for x in YV_blk_res])
+     return IV_ovl_orb, IV_ovl_riv, IV_cnd_cnt, IV_tst_cnt
+
+
+#*******************************************************************************
+#Read the bounds of the features of a shapefile
+#*******************************************************************************
+#Reads all features sequentially but only keeps the bounds of their geometry,
+#as an array of (minx, miny, maxx, maxy), along with the river ID (as int64,
+#and the name of its attribute) for river features or the 'Mean_time' (as
+#float64) for orbit features. shp_bnds() reads the attribute YV_prp as
+#YV_prp_typ.
+
+def riv_shp_bnds(rrr_riv_shp):
+     with fiona.open(rrr_riv_shp, 'r') as rrr_riv_lay:
+          YV_riv_id=riv_id_nam(rrr_riv_lay, rrr_riv_shp)
+     IV_riv_tot_id,ZM_riv_bnd=shp_bnds(rrr_riv_shp, YV_riv_id, np.int64)
+     return YV_riv_id, IV_riv_tot_id, ZM_riv_bnd
+
+def orb_shp_bnds(rrr_orb_shp):
+     return shp_bnds(rrr_orb_shp, 'Mean_time', np.float64)
+
+def shp_bnds(rrr_shp, YV_prp, YV_prp_typ):
+     with fiona.open(rrr_shp, 'r') as rrr_lay:
+          ZV_prp=np.zeros(len(rrr_lay), dtype=YV_prp_typ)
+          ZM_bnd=np.zeros((len(rrr_lay), 4), dtype=np.float64)
+          for JS_fea, rrr_feat in enumerate(rrr_lay):
+               ZV_prp[JS_fea]=rrr_feat['properties'][YV_prp]
+               ZM_bnd[JS_fea, :]=shapely.geometry.shape(rrr_feat['geometry']).bounds
+     return ZV_prp, ZM_bnd
+
+
+#*******************************************************************************
+#Order features along a space-filling curve
+#*******************************************************************************
+#Returns the position of the center of each bounding box in ZM_bnd along a
+#Z-order (Morton) curve over the extent of all boxes, with 16 bits per axis.
+
+def sfc_key(ZM_bnd):
+     ZV_ctr_x=(ZM_bnd[:, 0]+ZM_bnd[:, 2])/2
+     ZV_ctr_y=(ZM_bnd[:, 1]+ZM_bnd[:, 3])/2
+     IV_key=np.zeros(len(ZM_bnd), dtype=np.uint64)
+     for ZV_ctr, IS_sft in [(ZV_ctr_x, 0), (ZV_ctr_y, 1)]:
+          ZS_min=ZV_ctr.min() if len(ZV_ctr) > 0 else 0.0
+          ZS_rng=max(ZV_ctr.max()-ZS_min, 1e-12) if len(ZV_ctr) > 0 else 1.0
+          IV_crd=np.clip((ZV_ctr-ZS_min)/ZS_rng*65535, 0, 65535).astype(np.uint64)
+          for JS_bit in range(16):
+               IV_key|=((IV_crd >> np.uint64(JS_bit)) & np.uint64(1))          \
+                       << np.uint64(2*JS_bit+IS_sft)
+     return IV_key
+
+
+#*******************************************************************************
+#Find river features completely contained in orbit features, tile by tile
+#*******************************************************************************
+#Out-of-core version of ovl_riv_orb() that never holds more than one tile of
+#river geometries in memory. The river features are sorted along a
+#space-filling curve from their bounds ZM_riv_bnd, and cut into tiles of
+#IS_til_siz features. For each tile, only the orbit features whose bounds
+#intersect the bounds of the tile are decoded (those already decoded for the
+#previous tile are kept), the river features of the tile are read by random
+#access, and the overlays of the tile are appended to temporary files next to
+#rrr_til_out. Returns the same values as ovl_riv_orb(), the counts of each
+#orbit feature being summed over the tiles.
+
+def ovl_riv_orb_til(rrr_riv_shp, rrr_orb_shp, ZM_riv_bnd, ZM_orb_bnd,          \
+                    IS_til_siz, rrr_til_out, IS_wrk=1):
+     IV_riv_srt=np.argsort(sfc_key(ZM_riv_bnd), kind='stable')
+     IS_til_tot=(len(IV_riv_srt)+IS_til_siz-1)//IS_til_siz
+     print('- The number of tiles is: '+str(IS_til_tot))
+
+     IV_cnd_cnt=np.zeros(len(ZM_orb_bnd), dtype=np.int64)
+     IV_tst_cnt=np.zeros(len(ZM_orb_bnd), dtype=np.int64)
+     rrr_til_dir=os.path.dirname(os.path.abspath(rrr_til_out))
+     with tempfile.TemporaryDirectory(dir=rrr_til_dir) as rrr_tmp_dir:
+          rrr_ovl_orb_bin=os.path.join(rrr_tmp_dir, 'ovl_orb.bin')
+          rrr_ovl_riv_bin=os.path.join(rrr_tmp_dir, 'ovl_riv.bin')
+          with fiona.open(rrr_riv_shp, 'r') as rrr_riv_lay,                    \
+               fiona.open(rrr_orb_shp, 'r') as rrr_orb_lay,                    \
+               open(rrr_ovl_orb_bin, 'wb') as rrr_ovl_orb_fil,                 \
+               open(rrr_ovl_riv_bin, 'wb') as rrr_ovl_riv_fil:
+               IM_orb_geo={}
+               for JS_til in range(IS_til_tot):
+                    IV_til=np.sort(IV_riv_srt[JS_til*IS_til_siz:               \
+                                              (JS_til+1)*IS_til_siz])
+                    ZV_til_bnd=np.concatenate((ZM_riv_bnd[IV_til, :2].min(axis=0),
+                                               ZM_riv_bnd[IV_til, 2:].max(axis=0)))
+                    IV_orb_sel=np.flatnonzero(                                 \
+                              (ZM_orb_bnd[:, 0] <= ZV_til_bnd[2])              \
+                            & (ZM_orb_bnd[:, 2] >= ZV_til_bnd[0])              \
+                            & (ZM_orb_bnd[:, 1] <= ZV_til_bnd[3])              \
+                            & (ZM_orb_bnd[:, 3] >= ZV_til_bnd[1]))
+                    IM_orb_geo=dict((JS_orb, IM_orb_geo[JS_orb]                \
+                                     if JS_orb in IM_orb_geo else              \
+                                     shapely.geometry.shape(                   \
+                                     rrr_orb_lay[int(JS_orb)]['geometry']))    \
+                                    for JS_orb in IV_orb_sel)
+                    if len(IV_orb_sel) == 0:
+                         continue
+
+                    riv_geo=np.array([shapely.geometry.shape(                  \
+                                      rrr_riv_lay[int(JS_riv)]['geometry'])    \
+                                      for JS_riv in IV_til], dtype=object)
+                    orb_geo=np.array([IM_orb_geo[JS_orb]                       \
+                                      for JS_orb in IV_orb_sel], dtype=object)
+                    IV_til_orb,IV_til_riv,IV_til_cnd,IV_til_tst=               \
+                                     ovl_riv_orb_par(riv_geo, orb_geo, IS_wrk)
+                    IV_cnd_cnt[IV_orb_sel]+=IV_til_cnd
+                    IV_tst_cnt[IV_orb_sel]+=IV_til_tst
+                    rrr_ovl_orb_fil.write(IV_orb_sel[IV_til_orb]               \
+                                          .astype(np.int64).tobytes())
+                    rrr_ovl_riv_fil.write(IV_til[IV_til_riv]                   \
+                                          .astype(np.int64).tobytes())
+                    del riv_geo, orb_geo
+
+          IV_ovl_orb=np.fromfile(rrr_ovl_orb_bin, dtype=np.int64)
+          IV_ovl_riv=np.fromfile(rrr_ovl_riv_bin, dtype=np.int64)
+
+     IV_ovl_srt=np.lexsort((IV_ovl_riv, IV_ovl_orb))
+     return IV_ovl_orb[IV_ovl_srt], IV_ovl_riv[IV_ovl_srt], IV_cnd_cnt,       \
+            IV_tst_cnt
+
+
+#*******************************************************************************
+#Fingerprint geometries
+#*******************************************************************************
+#Returns a 64-bit hash of the WKB of each geometry.
+
+def geo_key(geo):
+     ZV_key=np.empty(len(geo), dtype=np.uint64)
+     for JS_geo, geo_wkb in enumerate(shapely.to_wkb(geo)):
+          ZV_key[JS_geo]=int.from_bytes(hashlib.blake2b(geo_wkb,              \
+                                        digest_size=8).digest(), 'little')
+     return ZV_key
+
+
+#*******************************************************************************
+#Find river features completely contained in orbit features, incrementally
+#*******************************************************************************
+#The geometry fingerprints of all river and orbit features and the overlays
+#found are stored in rrr_ovl_sta. In a later run, the overlays between features
+#whose geometry did not change are carried over from rrr_ovl_sta, and the
+#containment is only tested for the orbit features that changed or were added
+#(against all river features) and for the river features that changed or were
+#added (against the other orbit features). Features are matched by geometry, so
+#a reordered shapefile is not a change; features whose geometry appears more
+#than once are always tested again. The overlay times are not stored, they are
+#always taken from the current 'Mean_time' of the orbit features. Returns the
+#same values as ovl_riv_orb(), the counts being those of the pairs of features
+#that were actually tested, and updates rrr_ovl_sta.
+
+def key_map(ZV_key_old, ZV_key_new):
+     #Index in ZV_key_old of each element of ZV_key_new, or -1 if the key is
+     #absent from ZV_key_old or not unique in either array
+     if len(ZV_key_old) == 0:
+          return np.full(len(ZV_key_new), -1, dtype=np.int64)
+     ZV_unq_old,IV_cnt_old=np.unique(ZV_key_old, return_counts=True)
+     ZV_unq_new,IV_cnt_new=np.unique(ZV_key_new, return_counts=True)
+     ZV_key_dup=np.concatenate((ZV_unq_old[IV_cnt_old > 1],                    \
+                                ZV_unq_new[IV_cnt_new > 1]))
+
+     IV_old_srt=np.argsort(ZV_key_old, kind='stable')
+     IV_pos=np.searchsorted(ZV_key_old[IV_old_srt], ZV_key_new)
+     IV_pos=np.minimum(IV_pos, len(ZV_key_old)-1)
+     IV_map=IV_old_srt[IV_pos]
+     BV_fnd=(ZV_key_old[IV_map] == ZV_key_new)                                 \
+            & ~np.isin(ZV_key_new, ZV_key_dup)
+     return np.where(BV_fnd, IV_map, -1)
+
+def ovl_riv_orb_inc(riv_geo, orb_geo, rrr_ovl_sta, IS_wrk=1):
+     ZV_riv_key=geo_key(riv_geo)
+     ZV_orb_key=geo_key(orb_geo)
+
+     if not os.path.isfile(rrr_ovl_sta):
+          print('- No previous overlay found, running full overlay')
+          IV_ovl_orb,IV_ovl_riv,IV_cnd_cnt,IV_tst_cnt=ovl_riv_orb_par(riv_geo, \
+                                                      orb_geo, IS_wrk)
+     else:
+          rrr_sta=np.load(rrr_ovl_sta)
+          IV_riv_map=key_map(rrr_sta['ZV_riv_key'], ZV_riv_key)
+          IV_orb_map=key_map(rrr_sta['ZV_orb_key'], ZV_orb_key)
+          IV_riv_chg=np.flatnonzero(IV_riv_map < 0)
+          IV_orb_chg=np.flatnonzero(IV_orb_map < 0)
+          IV_orb_kep=np.flatnonzero(IV_orb_map >= 0)
+          print('- Changed or added river features: '+str(len(IV_riv_chg)))
+          print('- Changed or added orbit features: '+str(len(IV_orb_chg)))
+
+          #Overlays between unchanged features, renumbered to current features
+          IV_riv_new=np.full(len(rrr_sta['ZV_riv_key']), -1, dtype=np.int64)
+          IV_riv_new[IV_riv_map[IV_riv_map >= 0]]=np.flatnonzero(IV_riv_map >= 0)
+          IV_orb_new=np.full(len(rrr_sta['ZV_orb_key']), -1, dtype=np.int64)
+          IV_orb_new[IV_orb_map[IV_orb_map >= 0]]=np.flatnonzero(IV_orb_map >= 0)
+          IV_kep_orb=IV_orb_new[rrr_sta['IV_ovl_orb']]
+          IV_kep_riv=IV_riv_new[rrr_sta['IV_ovl_riv']]
+          BV_kep=(IV_kep_orb >= 0) & (IV_kep_riv >= 0)
+
+          #Changed orbit features against all river features
+          IV_cnd_cnt=np.zeros(len(orb_geo), dtype=np.int64)
+          IV_tst_cnt=np.zeros(len(orb_geo), dtype=np.int64)
+          IV_chg_orb,IV_chg_riv,IV_cnd_cnt[IV_orb_chg],IV_tst_cnt[IV_orb_chg]= \
+                        ovl_riv_orb_par(riv_geo, orb_geo[IV_orb_chg], IS_wrk)
+          #Changed river features against unchanged orbit features
+          if len(IV_riv_chg) > 0 and len(IV_orb_kep) > 0:
+               IV_new_orb,IV_new_riv,IV_cnd_cnt[IV_orb_kep],                   \
+               IV_tst_cnt[IV_orb_kep]=ovl_riv_orb_par(riv_geo[IV_riv_chg],     \
+                                                      orb_geo[IV_orb_kep], IS_wrk)
+          else:
+               IV_new_orb=np.zeros(0, dtype=np.int64)
+               IV_new_riv=np.zeros(0, dtype=np.int64)
+
+          IV_ovl_orb=np.concatenate((IV_kep_orb[BV_kep], IV_orb_chg[IV_chg_orb], \
+                                     IV_orb_kep[IV_new_orb]))
+          IV_ovl_riv=np.concatenate((IV_kep_riv[BV_kep], IV_chg_riv,            \
+                                     IV_riv_chg[IV_new_riv]))
+          IV_ovl_srt=np.lexsort((IV_ovl_riv, IV_ovl_orb))
+          IV_ovl_orb=IV_ovl_orb[IV_ovl_srt]
+          IV_ovl_riv=IV_ovl_riv[IV_ovl_srt]
+
+     np.savez(rrr_ovl_sta, ZV_riv_key=ZV_riv_key, ZV_orb_key=ZV_orb_key,       \
+              IV_ovl_orb=IV_ovl_orb, IV_ovl_riv=IV_ovl_riv)
+     return IV_ovl_orb, IV_ovl_riv, IV_cnd_cnt, IV_tst_cnt
+
+
+#*******************************************************************************
+#Compressed sparse row representation of the overlays
+#*******************************************************************************
+#Groups the overlays by river reach ID rather than by river feature, so that
+#reaches split over several features with the same ID (as found for some
+#COMIDs) are listed once, and an orbit pass containing several such features
+#is only counted once. Returns:
+#- IV_csr_id: the sorted unique IDs of all river features, with or without
+#  overlays
+#- IV_csr_off: the offsets of the overlays of each ID, the overlays of
+#  IV_csr_id[i] being at IV_csr_off[i]:IV_csr_off[i+1]
+#- ZV_csr_tim: the overlay times, in float64
+#- IV_csr_orb: the index of the orbit feature of each overlay, in int32
+#The overlays of each ID are sorted by orbit feature. IV_csr_id, IV_csr_off and
+#ZV_csr_tim can be given as such to the sampling stage (see ovl_pln()).
+
+def ovl_csr(IV_riv_tot_id, IV_ovl_riv, IV_ovl_orb, ZV_orb_tim):
+     IV_csr_id=np.unique(IV_riv_tot_id)
+     IV_ovl_id=IV_riv_tot_id[IV_ovl_riv]
+     IV_ovl_srt=np.lexsort((IV_ovl_orb, IV_ovl_id))
+     IV_ovl_id=IV_ovl_id[IV_ovl_srt]
+     IV_ovl_orb=IV_ovl_orb[IV_ovl_srt]
+
+     BV_unq=np.ones(len(IV_ovl_id), dtype=bool)
+     BV_unq[1:]=(IV_ovl_id[1:] != IV_ovl_id[:-1])                              \
+                | (IV_ovl_orb[1:] != IV_ovl_orb[:-1])
+     IV_ovl_id=IV_ovl_id[BV_unq]
+     IV_ovl_orb=IV_ovl_orb[BV_unq]
+
+     IV_csr_off=np.zeros(len(IV_csr_id)+1, dtype=np.int64)
+     IV_csr_off[1:]=np.cumsum(np.bincount(np.searchsorted(IV_csr_id,IV_ovl_id),\
+                                          minlength=len(IV_csr_id)))
+     ZV_csr_tim=np.asarray(ZV_orb_tim, dtype=np.float64)[IV_ovl_orb]
+     IV_csr_orb=IV_ovl_orb.astype(np.int32)
+     return IV_csr_id, IV_csr_off, ZV_csr_tim, IV_csr_orb
+
+
+#*******************************************************************************
+#Look up the overlays of a river reach
+#*******************************************************************************
+#Returns views of the overlay times and orbit features of the river reach ID
+#IS_riv_id, which are empty if the reach has no overlays. Raises KeyError if
+#the ID is not in the river network.
+
+def csr_get(IV_csr_id, IV_csr_off, ZV_csr_tim, IV_csr_orb, IS_riv_id):
+     JS_csr=np.searchsorted(IV_csr_id, IS_riv_id)
+     if JS_csr == len(IV_csr_id) or IV_csr_id[JS_csr] != IS_riv_id:
+          raise KeyError(IS_riv_id)
+     IS_beg=IV_csr_off[JS_csr]
+     IS_end=IV_csr_off[JS_csr+1]
+     return ZV_csr_tim[IS_beg:IS_end], IV_csr_orb[IS_beg:IS_end]
+
+
+#*******************************************************************************
+#Flatten the overlays
+#*******************************************************************************
+#Returns the reach ID and time of every overlay, in the long format used by the
+#overlay output and the sampling stage. The times are the CSR array itself.
+
+def csr_flat(IV_csr_id, IV_csr_off, ZV_csr_tim):
+     return np.repeat(IV_csr_id, np.diff(IV_csr_off)), ZV_csr_tim
+
+
+#*******************************************************************************
+#Find the first and last overlay time of each river feature
+#*******************************************************************************
+#Returns the earliest and latest of the overlay times ZV_ovl_tim of each of the
+#IS_riv_tot river features, NaN for the river features without overlays.
+
+def ovl_fst_lst(IV_ovl_riv, ZV_ovl_tim, IS_riv_tot):
+     ZV_ovl_fst=np.full(IS_riv_tot, np.inf)
+     ZV_ovl_lst=np.full(IS_riv_tot, -np.inf)
+     np.minimum.at(ZV_ovl_fst, IV_ovl_riv, ZV_ovl_tim)
+     np.maximum.at(ZV_ovl_lst, IV_ovl_riv, ZV_ovl_tim)
+     ZV_ovl_fst[np.isinf(ZV_ovl_fst)]=np.nan
+     ZV_ovl_lst[np.isinf(ZV_ovl_lst)]=np.nan
+     return ZV_ovl_fst, ZV_ovl_lst
+
+
+#*******************************************************************************
+#Write the overlay shapefile
+#*******************************************************************************
+#Copies rrr_riv_shp into rrr_ovl_shp in one sequential pass over the river
+#layer, adding the number of overlays of each river feature in 'OVERLAYS' and,
+#if given, the first and last overlay times in 'FIRST_TIME' and 'LAST_TIME'.
+#Records are buffered and written IS_buf at a time.
+
+def ovl_shp_write(rrr_riv_shp, rrr_ovl_shp, IV_ovl_cnt, ZV_ovl_fst=None,       \
+                  ZV_ovl_lst=None, IS_buf=10000):
+     with fiona.open(rrr_riv_shp, 'r') as rrr_riv_lay:
+          rrr_ovl_sch=rrr_riv_lay.schema.copy()
+          rrr_ovl_sch['properties']=rrr_ovl_sch['properties'].copy()
+          rrr_ovl_sch['properties']['OVERLAYS']='int:9'
+          if ZV_ovl_fst is not None:
+               rrr_ovl_sch['properties']['FIRST_TIME']='float:24.15'
+               rrr_ovl_sch['properties']['LAST_TIME']='float:24.15'
+
+          with fiona.open(rrr_ovl_shp, 'w', driver='ESRI Shapefile',           \
+                          crs_wkt=rrr_riv_lay.crs_wkt,                         \
+                          schema=rrr_ovl_sch) as rrr_ovl_lay:
+               YV_ovl_buf=[]
+               for JS_riv_tot, rrr_riv_feat in enumerate(rrr_riv_lay):
+                    rrr_ovl_prp=dict(rrr_riv_feat['properties'])
+                    rrr_ovl_prp['OVERLAYS']=int(IV_ovl_cnt[JS_riv_tot])
+                    if ZV_ovl_fst is not None:
+                         rrr_ovl_prp['FIRST_TIME']=None                        \
+                              if np.isnan(ZV_ovl_fst[JS_riv_tot])              \
+                              else float(ZV_ovl_fst[JS_riv_tot])
+                         rrr_ovl_prp['LAST_TIME']=None                         \
+                              if np.isnan(ZV_ovl_lst[JS_riv_tot])              \
+                              else float(ZV_ovl_lst[JS_riv_tot])
+                    YV_ovl_buf.append({'properties': rrr_ovl_prp,              \
+                                       'geometry': rrr_riv_feat['geometry']})
+                    if len(YV_ovl_buf) == IS_buf:
+                         rrr_ovl_lay.writerecords(YV_ovl_buf)
+                         YV_ovl_buf=[]
+               rrr_ovl_lay.writerecords(YV_ovl_buf)
+
+
+#*******************************************************************************
+#End
+#*******************************************************************************
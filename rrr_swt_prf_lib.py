@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#******************************************************************************
+#rrr_swt_prf_lib.py
+#******************************************************************************
+#Purpose:
+#Instrumentation of the SWOT orbit scripts. Each stage records its wall time,
+#the peak resident memory of the process at its end, the number of times it
+#ran and counters such as the number of rows processed. The records are kept
+#in this module, can be written as a JSON or CSV report, and each stage can
+#optionally be profiled with cProfile.
+#Authors:
+#Cedric H. David, Etienne Fluet-Chouinard, 2016-2016
+
+
+#*******************************************************************************
+#Import Python modules
+#*******************************************************************************
+import os
+import csv
+import json
+import time
+import cProfile
+import contextlib
+try:
+     import resource
+except ImportError:
+     resource=None
+
+
+#*******************************************************************************
+#Declaration of variables
+#*******************************************************************************
+YM_prf={}
+#The records of each stage, in the order in which the stages first ran
+
+rrr_prf_dir=''
+#The directory where the cProfile statistics of each stage are dumped, if any
+
+YM_prf_pro={}
+#The cProfile profiler of each stage
+
+YS_prf_act=None
+#The stage being profiled, as cProfile cannot profile nested stages
+
+
+#*******************************************************************************
+#Initialize the instrumentation
+#*******************************************************************************
+#Clears all records, and enables the profiling of each stage into rrr_pro_dir
+#if it is given.
+
+def prf_ini(rrr_pro_dir=''):
+     global rrr_prf_dir, YS_prf_act
+     YM_prf.clear()
+     YM_prf_pro.clear()
+     YS_prf_act=None
+     rrr_prf_dir=rrr_pro_dir
+     if rrr_prf_dir != '' and not os.path.isdir(rrr_prf_dir):
+          os.makedirs(rrr_prf_dir)
+
+
+#*******************************************************************************
+#Peak resident memory of the process
+#*******************************************************************************
+#Returns the peak resident memory in MB, or None where it is not available.
+
+def prf_rss():
+     if resource is None:
+          return None
+     return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+
+#*******************************************************************************
+#Time a stage
+#*******************************************************************************
+#Context manager recording the wall time and peak memory of the stage YS_stg.
+#A stage that runs several times, e.g. once per block, accumulates its wall
+#time and number of calls.
+
+@contextlib.contextmanager
+def prf_stg(YS_stg):
+     global YS_prf_act
+     if YS_stg not in YM_prf:
+          YM_prf[YS_stg]={'wall_time_s': 0.0, 'calls': 0}
+     BS_pro=rrr_prf_dir != '' and YS_prf_act is None
+     if BS_pro:
+          YS_prf_act=YS_stg
+          if YS_stg not in YM_prf_pro:
+               YM_prf_pro[YS_stg]=cProfile.Profile()
+          YM_prf_pro[YS_stg].enable()
+     ZS_beg=time.time()
+     try:
+          yield
+     finally:
+          YM_prf[YS_stg]['wall_time_s']+=time.time()-ZS_beg
+          YM_prf[YS_stg]['calls']+=1
+          YM_prf[YS_stg]['peak_rss_mb']=prf_rss()
+          if BS_pro:
+               YM_prf_pro[YS_stg].disable()
+               YS_prf_act=None
+
+
+#*******************************************************************************
+#Count events of a stage
+#*******************************************************************************
+#Adds IS_val to the counter YS_cnt of the stage YS_stg, or sets it if BS_add
+#is False.
+
+def prf_cnt(YS_stg, YS_cnt, IS_val, BS_add=True):
+     if YS_stg not in YM_prf:
+          YM_prf[YS_stg]={'wall_time_s': 0.0, 'calls': 0}
+     if BS_add and YS_cnt in YM_prf[YS_stg]:
+          YM_prf[YS_stg][YS_cnt]+=IS_val
+     else:
+          YM_prf[YS_stg][YS_cnt]=IS_val
+
+
+#*******************************************************************************
+#Write the report
+#*******************************************************************************
+#Writes the records of all stages to rrr_prf_out, as JSON if its extension is
+#'.json' and as CSV with one (stage, metric, value) row per record otherwise,
+#and dumps the cProfile statistics of each stage as <stage>.prof.
+
+def prf_write(rrr_prf_out):
+     for YS_stg in YM_prf_pro:
+          YM_prf_pro[YS_stg].dump_stats(os.path.join(rrr_prf_dir,             \
+                                                     YS_stg+'.prof'))
+     if rrr_prf_out == '':
+          return
+
+     if os.path.splitext(rrr_prf_out)[1].lower() == '.json':
+          with open(rrr_prf_out, 'w') as jsonfile:
+               json.dump({'stages': YM_prf,                                    \
+                          'total_wall_time_s':                                 \
+                          sum(x['wall_time_s'] for x in YM_prf.values()),      \
+                          'peak_rss_mb': prf_rss()}, jsonfile, indent=1)
+     else:
+          with open(rrr_prf_out, 'w', newline='') as csvfile:
+               csvwriter=csv.writer(csvfile, dialect='excel')
+               csvwriter.writerow(['stage', 'metric', 'value'])
+               for YS_stg in YM_prf:
+                    for YS_cnt in YM_prf[YS_stg]:
+                         csvwriter.writerow([YS_stg, YS_cnt,                   \
+                                             YM_prf[YS_stg][YS_cnt]])
+
+
+#*******************************************************************************
+#End
+#*******************************************************************************
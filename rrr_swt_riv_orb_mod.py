@@ -11,11 +11,14 @@
 #%%*****************************************************************************
 # Import Python modules
 #*******************************************************************************
-import sys
-import netCDF4
-import xray
+import os
+import json
+import time
 import numpy as np
-import pandas as pd
+import rrr_swt_arg_lib
+import rrr_swt_mod_lib
+import rrr_swt_out_lib
+import rrr_swt_prf_lib
 
 
 #%%*****************************************************************************
@@ -24,19 +27,79 @@ import pandas as pd
 # 1 - rrr_mod_nc1
 # 2 - rrr_ovl_csv
 # 3 - rrr_mod_nc2
+#Options:
+# --tolerance=ZS_tol - drop passes more than ZS_tol seconds from any model step
+# --cycle_length=ZS_cyc - duration of one orbit repeat cycle (default: 1802700)
+# --cycles=IS_cyc - number of orbit cycles (default: cover the model time axis)
+# --format=YS_fmt - csv, netcdf or parquet (default: from rrr_mod_nc2 extension)
+# --report=rrr_prf_out - write stage timings and counters (.json or .csv)
+# --profile=rrr_pro_dir - dump cProfile statistics of each stage there
+# --plan=rrr_pln_npz - also save the sampling plan of rrr_mod_nc1 there
+# --apply - rrr_ovl_csv is a sampling plan saved with --plan, applied to
+#           rrr_mod_nc1 which must have the same reach and time axes (the
+#           tolerance and cycle options are then those of the plan)
+# --workers=IS_wrk - number of processes reading the members of an ensemble,
+#                    or running the partitions
+# --partitions=IS_par - split the job into IS_par ranges of reaches, sampled
+#                       separately and concatenated in order into rrr_mod_nc2
+#                       (the rows are then grouped by range of reaches)
+# --executor=YS_exe - local (process pool, default) or dask, for partitions
+# --scheduler=rrr_sch_adr - address of the Dask scheduler (default: a new
+#                           cluster of IS_wrk processes on this machine)
+# --follow=ZS_pol - rrr_mod_nc1 is still being written: sample the passes as
+#                   new time steps appear, checking every ZS_pol seconds
+#                   (default: 60), and keep a checkpoint in
+#                   rrr_mod_nc2.follow.json to restart from
+# --idle=IS_idl - in follow mode, the model run is finished once the time axis
+#                 has not grown for IS_idl checks (default: 10)
+# --estimators=YS_est - comma-separated list of estimators of Qout at the pass
+#                       times added as columns Qout_<estimator> next to the
+#                       closest time step: linear (interpolation between the
+#                       bracketing time steps), mean, min and max (over the
+#                       time steps within ZS_est_win of the pass)
+# --window=ZS_est_win - half-width of the window of mean, min and max in
+#                       seconds (default: one model time step)
+#Ensembles:
+# rrr_mod_nc1 can be a comma-separated list of files or glob patterns with the
+# same reach and time axes. The sampling plan is then compiled once for the
+# first member, and the output has one column Qout_<i> per member (in the
+# printed order), stored as Qout along an 'ensemble' dimension in NetCDF.
 
 
 #%%*****************************************************************************
 #  Get command line arguments
 #*******************************************************************************
-IS_arg=len(sys.argv)
-if IS_arg != 4:
-     print('ERROR - 3 and only 3 arguments can be used')
-     raise SystemExit(22) 
-
-rrr_mod_nc1 = sys.argv[1]
-rrr_ovl_csv = sys.argv[2]
-rrr_mod_csv_out = sys.argv[3]
+YV_arg,YM_opt=rrr_swt_arg_lib.arg_get(3, ['tolerance', 'cycle_length', 'cycles',
+                                         'format', 'report', 'profile',
+                                         'plan', 'apply', 'workers',
+                                         'follow', 'idle', 'partitions',
+                                         'executor', 'scheduler',
+                                         'estimators', 'window'])
+
+rrr_mod_nc1 = YV_arg[0]
+rrr_ovl_csv = YV_arg[1]
+rrr_mod_csv_out = YV_arg[2]
+ZS_tol = rrr_swt_arg_lib.opt_float(YM_opt, 'tolerance', None)
+ZS_cyc = rrr_swt_arg_lib.opt_float(YM_opt, 'cycle_length', 1802700)
+IS_cyc = rrr_swt_arg_lib.opt_int(YM_opt, 'cycles', None)
+YS_fmt = rrr_swt_out_lib.out_fmt(rrr_mod_csv_out, YM_opt.get('format'))
+rrr_prf_out = YM_opt.get('report', '')
+rrr_pro_dir = YM_opt.get('profile', '')
+rrr_pln_npz = YM_opt.get('plan', '')
+BS_app = 'apply' in YM_opt
+IS_wrk = rrr_swt_arg_lib.opt_int(YM_opt, 'workers', 1)
+YV_mod_nc = rrr_swt_mod_lib.mod_nc_lst(rrr_mod_nc1)
+BS_ens = len(YV_mod_nc) != 1 or YV_mod_nc[0] != rrr_mod_nc1
+BS_fol = 'follow' in YM_opt
+ZS_pol = rrr_swt_arg_lib.opt_float(YM_opt, 'follow', 60)
+IS_idl = rrr_swt_arg_lib.opt_int(YM_opt, 'idle', 10)
+rrr_fol_jsn = rrr_mod_csv_out.rstrip('/\\')+'.follow.json'
+IS_par = rrr_swt_arg_lib.opt_int(YM_opt, 'partitions', 0)
+YS_exe = YM_opt.get('executor', 'local')
+rrr_sch_adr = YM_opt.get('scheduler', '')
+YV_est = [x for x in YM_opt.get('estimators', '').split(',') if x != '']
+ZS_est_win = rrr_swt_arg_lib.opt_float(YM_opt, 'window', None)
+rrr_swt_prf_lib.prf_ini(rrr_pro_dir)
 
 
 #%%*****************************************************************************
@@ -44,119 +107,222 @@ rrr_mod_csv_out = sys.argv[3]
 #*******************************************************************************
 print('Command line inputs')
 print('- '+rrr_mod_nc1)
+if BS_ens:
+     for JS_ens in range(len(YV_mod_nc)):
+          print('  - Ensemble member '+str(JS_ens)+': '+YV_mod_nc[JS_ens])
 print('- '+rrr_ovl_csv)
 print('- '+rrr_mod_csv_out)
+if ZS_tol is not None:
+     print('- Maximum time difference (s): '+str(ZS_tol))
+print('- Orbit cycle length (s): '+str(ZS_cyc))
+print('- Output format: '+YS_fmt)
+if rrr_prf_out != '':
+     print('- Report: '+rrr_prf_out)
+if rrr_pln_npz != '':
+     print('- Sampling plan: '+rrr_pln_npz)
+if BS_app:
+     print('- Applying the sampling plan: '+rrr_ovl_csv)
+if BS_fol:
+     print('- Following the model output every (s): '+str(ZS_pol))
+     print('- Checkpoint: '+rrr_fol_jsn)
+if IS_par > 0:
+     print('- Number of partitions: '+str(IS_par)+', executor: '+YS_exe)
+if len(YV_est) > 0:
+     print('- Estimators: '+', '.join(YV_est))
+if ZS_est_win is not None:
+     print('- Estimator window half-width (s): '+str(ZS_est_win))
 
 
 #%%*****************************************************************************
 #  Check if files exist 
 #*******************************************************************************
 
-try:
-     with open(rrr_mod_nc1) as file:
-          pass
-except IOError as e:
-     print('ERROR - Unable to open '+rrr_mod_nc1)
+if len(YV_mod_nc) == 0:
+     print('ERROR - No file matches '+rrr_mod_nc1)
      raise SystemExit(22) 
 
-try:
-     with open(rrr_ovl_csv) as file:
-          pass
-except IOError as e:
+for rrr_mod_ncx in YV_mod_nc:
+     try:
+          with open(rrr_mod_ncx) as file:
+               pass
+     except IOError as e:
+          print('ERROR - Unable to open '+rrr_mod_ncx)
+          raise SystemExit(22) 
+
+if not os.path.exists(rrr_ovl_csv):
      print('ERROR - Unable to open '+rrr_ovl_csv)
      raise SystemExit(22) 
 
+if BS_app and rrr_pln_npz != '':
+     print('ERROR - The plan and apply options cannot be used together')
+     raise SystemExit(22) 
 
+if BS_fol and (BS_app or BS_ens or rrr_pln_npz != ''):
+     print('ERROR - The follow option cannot be used with plans or ensembles')
+     raise SystemExit(22) 
 
-#%%*****************************************************************************
-#  read the csv output from the intersection, and sort values (optional)
-#*******************************************************************************
-
-rrr_ovl_df = pd.read_csv(rrr_ovl_csv, dtype=int)
-rrr_ovl_df = rrr_ovl_df.sort_values(by='IM_ovl_tim')
-
-
-#%%*****************************************************************************
-#  Extend the SWOT orbit timepoints by repeating the time cycle.
-#*******************************************************************************
-# There are 69 complete cycles of 20 days in the three years of 2004-07 covered by Rapid data.
-# Assuming that the orbit cycles are identical, we extend the orbit timing 
-# by adding cycles of 1802700 seconds to the river overlay of the initial cycle.
-
-rrr_ovl_df_yrs = rrr_ovl_df.copy(deep=True)
-
-for i in range(1,69):
-
-    rrr_ovl_df_yrs['IM_ovl_tim'] = rrr_ovl_df_yrs['IM_ovl_tim'] + 1802700
-    rrr_ovl_df = pd.concat([rrr_ovl_df, rrr_ovl_df_yrs])
-
-del rrr_ovl_df_yrs
-
-
-#%%*****************************************************************************
-#  read the netcdf file to dataframe
-#*******************************************************************************
-
-da = xray.open_dataset(rrr_mod_nc1)
-rrr_mod_df1 = da.to_dataframe()
+if IS_par > 0 and (BS_fol or BS_app or BS_ens or rrr_pln_npz != ''):
+     print('ERROR - The partitions option cannot be used with follow, plans '  \
+           +'or ensembles')
+     raise SystemExit(22) 
 
-# convert multi-level index to columns, for merger
-rrr_mod_df1.reset_index(inplace=True)
+rrr_swt_mod_lib.est_chk(YV_est)
 
-# Convert time steps to seconds to match SWOT time format.
-rrr_mod_df1['Time_sec'] = (rrr_mod_df1['Time'] * (3*60*60)).astype(int)
+if len(YV_est) > 0 and (BS_fol or BS_app or BS_ens or rrr_pln_npz != ''):
+     print('ERROR - The estimators option cannot be used with follow, plans '  \
+           +'or ensembles')
+     raise SystemExit(22) 
 
-# Remove old time step column
-rrr_mod_df1.drop('Time', axis=1, inplace=True)
+if YS_exe not in rrr_swt_mod_lib.YV_exe_all:
+     print('ERROR - The executor must be one of: '                             \
+           +', '.join(rrr_swt_mod_lib.YV_exe_all))
+     raise SystemExit(22) 
 
 
 
 #%%*****************************************************************************
-#  Find the closest sec
+#  read the csv (or netcdf/parquet) output from the intersection
 #*******************************************************************************
-# takes a pd.Timestamp() instance and a pd.Series with dates in it
-# calcs the delta between `timepoint` and each date in `time_series`
-# returns the closest date and optionally the number of days in its time delta
 
-def find_closest_date(timepoint, time_series, add_time_delta_column=True):
-    deltas = np.abs(time_series - timepoint)
-    idx_closest_date = np.argmin(deltas)
-    res = {"closest_date": time_series.ix[idx_closest_date]}
-    idx = ['closest_date']
-    if add_time_delta_column:
-        res["closest_delta"] = deltas[idx_closest_date]
-        idx.append('closest_delta')
-    return pd.Series(res, index=idx)
+if BS_app:
+    with rrr_swt_prf_lib.prf_stg('read_plan'):
+        YM_pln = rrr_swt_mod_lib.pln_read(rrr_ovl_csv)
+    rrr_swt_prf_lib.prf_cnt('read_plan', 'rows', len(YM_pln['IV_clo']))
+else:
+    with rrr_swt_prf_lib.prf_stg('read_overlays'):
+        rrr_ovl_df = rrr_swt_out_lib.out_read(rrr_ovl_csv, YV_col=['IS_riv_id', 'IM_ovl_tim'])
+    rrr_swt_prf_lib.prf_cnt('read_overlays', 'rows', len(rrr_ovl_df))
 
 
 #%%*****************************************************************************
-#  Subset the Qout time series to the SWOT time-points
+#  Sample Qout at the SWOT time-points and write output file
 #*******************************************************************************
-
-# Subset the  Rapid Qout data to the river reaches in input.
-# This first selection speeds up the subsequent riv+time selection.
-rrr_mod_df1 = rrr_mod_df1[rrr_mod_df1['COMID'].isin(rrr_ovl_df['IS_riv_id'])]
-
-# Create series of unique time steps. 
-# Because river reaches all share the same time steps, we can pair 
-unique_rrr_time = pd.Series(rrr_mod_df1['Time_sec'].unique())
-
-# Find the closest matching time, calculate distance/difference in seconds between the two.
-# add the time and difference to the table
-rrr_ovl_df[['closest_rrr_time', 'secs_diff']] = rrr_ovl_df.IM_ovl_tim.apply(find_closest_date, args=[unique_rrr_time])
-
-# Join the timeseries and timepoints, on river_id and time_stamp. 
-rrr_ovl_df_qout = pd.merge(rrr_ovl_df, rrr_mod_df1, how='inner', left_on=['IS_riv_id','closest_rrr_time'], right_on=['COMID','Time_sec'])
-
-# drop duplicated columns in the joined table; remove unneeded variables.
-rrr_ovl_df_qout.drop(['COMID','Time_sec'], axis=1, inplace=True)
-
-del rrr_ovl_csv, rrr_mod_nc1, rrr_ovl_df, rrr_mod_df1, unique_rrr_time, i
+# The overlays of the initial cycle are sorted by time and extended by
+# repeating the orbit cycle, assuming that the orbit cycles are identical.
+# Unless a number of cycles is given, the cycles are repeated over the time axis
+# of the model and the passes outside of it are dropped. Each pass is matched to
+# the closest model time step, and Qout is read only at the matching (time,
+# river reach) cells. The cycles are expanded a block at a time, and each block
+# is sampled and written before the next one.
+# A sampling plan holds all these matching cells at once, so that they are
+# compiled once and Qout is gathered at all of them in one pass for each model
+# output they apply to, e.g. to all members of an ensemble.
+# The estimators other than the closest time step gather, along with it, all
+# the time steps they need for each pass in the same pass over Qout.
+
+if not BS_app and (BS_ens or rrr_pln_npz != ''):
+    YM_pln = rrr_swt_mod_lib.pln_mak(YV_mod_nc[0],                           \
+                                     rrr_ovl_df['IS_riv_id'].values,           \
+                                     rrr_ovl_df['IM_ovl_tim'].values,          \
+                                     ZS_cyc=ZS_cyc, IS_cyc=IS_cyc, ZS_tol=ZS_tol)
+    if rrr_pln_npz != '':
+        rrr_swt_mod_lib.pln_write(rrr_pln_npz, YM_pln)
+
+if BS_ens:
+    rrr_smp_blk = rrr_swt_mod_lib.pln_smp_ens(YV_mod_nc, YM_pln, IS_wrk)
+elif BS_app or rrr_pln_npz != '':
+    rrr_smp_blk = rrr_swt_mod_lib.pln_smp(rrr_mod_nc1, YM_pln)
+else:
+    rrr_smp_blk = rrr_swt_mod_lib.ovl_smp(rrr_mod_nc1,                       \
+                                          rrr_ovl_df['IS_riv_id'].values,      \
+                                          rrr_ovl_df['IM_ovl_tim'].values,     \
+                                          ZS_cyc=ZS_cyc, IS_cyc=IS_cyc,        \
+                                          ZS_tol=ZS_tol, YV_est=YV_est,        \
+                                          ZS_est_win=ZS_est_win)
+
+IS_row_out = 0
+BS_fst = True
+if IS_par > 0:
+    with rrr_swt_mod_lib.par_exe(YS_exe, IS_wrk, rrr_sch_adr) as rrr_exe:
+        IS_row_out = rrr_swt_mod_lib.par_smp(rrr_mod_nc1,                    \
+                                             rrr_ovl_df['IS_riv_id'].values,   \
+                                             rrr_ovl_df['IM_ovl_tim'].values,  \
+                                             rrr_mod_csv_out, YS_fmt, IS_par,  \
+                                             rrr_exe,                          \
+                                             {'ZS_cyc': ZS_cyc,                \
+                                              'IS_cyc': IS_cyc,                \
+                                              'ZS_tol': ZS_tol,                \
+                                              'YV_est': YV_est,                \
+                                              'ZS_est_win': ZS_est_win})
+elif not BS_fol:
+    for rrr_ovl_df_qout in rrr_smp_blk:
+        with rrr_swt_prf_lib.prf_stg('write_output'):
+            rrr_swt_out_lib.out_write(rrr_mod_csv_out, YS_fmt, rrr_ovl_df_qout, BS_fst,
+                                      YV_mod_nc if BS_ens else None)
+        rrr_swt_prf_lib.prf_cnt('write_output', 'rows', len(rrr_ovl_df_qout))
+        BS_fst = False
+        IS_row_out = IS_row_out + len(rrr_ovl_df_qout)
 
 
 #%%*****************************************************************************
-# Write output to CSV file
+#  Follow the model output as it is written
 #*******************************************************************************
-
-rrr_ovl_df_qout.to_csv(rrr_mod_csv_out)
+# A pass is final once the model time axis reaches it, as later time steps
+# cannot be closer. Each check samples the passes between the end of the time
+# axis at the previous check and its current end, and appends them to the
+# output. The last time step is held back until the run is finished as it may
+# not be completely written yet. Reading a NetCDF-4 file while it is written
+# requires HDF5 file locking to be disabled (HDF5_USE_FILE_LOCKING=FALSE) for
+# both the model and this script. The end of the time axis that was sampled,
+# the number of rows written and the size of the output are kept in a
+# checkpoint after each check, and anything written after the checkpoint is
+# dropped when restarting.
+
+if BS_fol:
+    ZS_aft = -np.inf
+    if os.path.exists(rrr_fol_jsn) and os.path.exists(rrr_mod_csv_out):
+        with open(rrr_fol_jsn, 'r') as jsonfile:
+            YM_fol = json.load(jsonfile)
+        ZS_aft = YM_fol['last_time']
+        IS_row_out = YM_fol['rows']
+        rrr_swt_out_lib.out_trunc(rrr_mod_csv_out, YS_fmt, YM_fol['size'])
+        BS_fst = False
+        print('- Restarting after model time (s): '+str(ZS_aft))
+
+    IS_tim_old = None
+    IS_idl_cnt = 0
+    while True:
+        IS_tim_tot, ZS_end = rrr_swt_mod_lib.mod_nc_end(rrr_mod_nc1, 1)
+        if IS_tim_tot == IS_tim_old:
+            IS_idl_cnt = IS_idl_cnt + 1
+        else:
+            IS_idl_cnt = 0
+        BS_lst = IS_idl_cnt >= IS_idl
+        if BS_lst:
+            IS_tim_tot, ZS_end = rrr_swt_mod_lib.mod_nc_end(rrr_mod_nc1, 0)
+
+        if ZS_end > ZS_aft:
+            for rrr_ovl_df_qout in rrr_swt_mod_lib.ovl_smp(rrr_mod_nc1,      \
+                                   rrr_ovl_df['IS_riv_id'].values,             \
+                                   rrr_ovl_df['IM_ovl_tim'].values,            \
+                                   ZS_cyc=ZS_cyc, IS_cyc=IS_cyc, ZS_tol=ZS_tol,\
+                                   ZV_win=(ZS_aft, ZS_end)):
+                rrr_ovl_df_qout.index = rrr_ovl_df_qout.index + IS_row_out
+                with rrr_swt_prf_lib.prf_stg('write_output'):
+                    rrr_swt_out_lib.out_write(rrr_mod_csv_out, YS_fmt,        \
+                                              rrr_ovl_df_qout, BS_fst)
+                rrr_swt_prf_lib.prf_cnt('write_output', 'rows', len(rrr_ovl_df_qout))
+                BS_fst = False
+                IS_row_out = IS_row_out + len(rrr_ovl_df_qout)
+            ZS_aft = ZS_end
+            with open(rrr_fol_jsn+'.tmp', 'w') as jsonfile:
+                json.dump({'last_time': ZS_aft, 'rows': IS_row_out,          \
+                           'size': rrr_swt_out_lib.out_size(rrr_mod_csv_out,   \
+                                                            YS_fmt)}, jsonfile)
+            os.replace(rrr_fol_jsn+'.tmp', rrr_fol_jsn)
+            print('- Sampled up to model time (s): '+str(ZS_aft))
+
+        if BS_lst:
+            break
+        IS_tim_old = IS_tim_tot
+        time.sleep(ZS_pol)
+
+print('- Number of sampled SWOT time-points: '+str(IS_row_out))
+
+if rrr_prf_out != '' or rrr_pro_dir != '':
+    print('Writing report')
+    rrr_swt_prf_lib.prf_write(rrr_prf_out)
+
+# remove unneeded variables.
+del rrr_ovl_csv, rrr_mod_nc1
 del rrr_mod_csv_out
@@ -11,11 +11,13 @@
 #*******************************************************************************
 #Import Python modules
 #*******************************************************************************
-import sys
-import fiona
-import shapely.geometry
-import rtree
 import csv
+import numpy as np
+import pandas as pd
+import rrr_swt_arg_lib
+import rrr_swt_ovl_lib
+import rrr_swt_out_lib
+import rrr_swt_prf_lib
 
 
 #*******************************************************************************
@@ -25,20 +27,41 @@ import csv
 # 2 - rrr_orb_shp
 # 3 - rrr_ovl_shp
 # 4 - rrr_ovl_csv
+#Options:
+# --workers=IS_wrk  - number of processes used for the overlay (default: 1)
+# --cache=rrr_cch_dir - directory caching the decoded river geometries
+# --format=YS_fmt - csv, netcdf or parquet (default: from rrr_ovl_csv extension)
+# --incremental - only test the features that changed since the previous run,
+#                 whose fingerprints are kept in rrr_ovl_csv.state.npz
+# --pass_times - add the first and last overlay times to rrr_ovl_shp
+# --report=rrr_prf_out - write stage timings and counters (.json or .csv)
+# --profile=rrr_pro_dir - dump cProfile statistics of each stage there
+# --tile=IS_til_siz - process the river features in tiles of IS_til_siz
+#                     features along a space-filling curve, so that the river
+#                     geometries never all have to be in memory at once
 
 
 #*******************************************************************************
 #Get command line arguments
 #*******************************************************************************
-IS_arg=len(sys.argv)
-if IS_arg != 5:
-     print('ERROR - 4 and only 4 arguments can be used')
-     raise SystemExit(22) 
+YV_arg,YM_opt=rrr_swt_arg_lib.arg_get(4, ['workers', 'cache', 'format',
+                                         'incremental', 'pass_times',
+                                         'report', 'profile', 'tile'])
 
-rrr_riv_shp=sys.argv[1]
-rrr_orb_shp=sys.argv[2]
-rrr_ovl_shp=sys.argv[3]
-rrr_ovl_csv=sys.argv[4]
+rrr_riv_shp=YV_arg[0]
+rrr_orb_shp=YV_arg[1]
+rrr_ovl_shp=YV_arg[2]
+rrr_ovl_csv=YV_arg[3]
+IS_wrk=rrr_swt_arg_lib.opt_int(YM_opt, 'workers', 1)
+rrr_cch_dir=YM_opt.get('cache', '')
+YS_fmt=rrr_swt_out_lib.out_fmt(rrr_ovl_csv, YM_opt.get('format'))
+BS_inc='incremental' in YM_opt
+BS_pas='pass_times' in YM_opt
+rrr_ovl_sta=rrr_ovl_csv.rstrip('/\\')+'.state.npz'
+rrr_prf_out=YM_opt.get('report', '')
+rrr_pro_dir=YM_opt.get('profile', '')
+IS_til_siz=rrr_swt_arg_lib.opt_int(YM_opt, 'tile', 0)
+rrr_swt_prf_lib.prf_ini(rrr_pro_dir)
 
 
 #*******************************************************************************
@@ -49,6 +72,16 @@ print('- '+rrr_riv_shp)
 print('- '+rrr_orb_shp)
 print('- '+rrr_ovl_shp)
 print('- '+rrr_ovl_csv)
+print('- Number of workers: '+str(IS_wrk))
+if rrr_cch_dir != '':
+     print('- Cache directory: '+rrr_cch_dir)
+print('- Overlay output format: '+YS_fmt)
+if BS_inc:
+     print('- Incremental overlay state: '+rrr_ovl_sta)
+if rrr_prf_out != '':
+     print('- Report: '+rrr_prf_out)
+if IS_til_siz > 0:
+     print('- Number of river features per tile: '+str(IS_til_siz))
 
 
 #*******************************************************************************
@@ -68,50 +101,45 @@ except IOError as e:
      print('ERROR - Unable to open '+rrr_orb_shp)
      raise SystemExit(22) 
 
-
-#*******************************************************************************
-#Open rrr_riv_shp
-#*******************************************************************************
-print('Open rrr_riv_shp')
-
-rrr_riv_lay=fiona.open(rrr_riv_shp, 'r')
-IS_riv_tot=len(rrr_riv_lay)
-print('- The number of river features is: '+str(IS_riv_tot))
-
-if 'COMID' in rrr_riv_lay[0]['properties']:
-     YV_riv_id='COMID'
-elif 'ARCID' in rrr_riv_lay[0]['properties']:
-     YV_riv_id='ARCID'
-else:
-     print('ERROR - Neither COMID nor ARCID exist in '+rrr_riv_shp)
+if IS_til_siz > 0 and (BS_inc or rrr_cch_dir != ''):
+     print('ERROR - The tile option cannot be used with incremental or cache')
      raise SystemExit(22) 
 
-IV_riv_tot_id=[]
-for JS_riv_tot in range(IS_riv_tot):
-     IV_riv_tot_id.append(int(rrr_riv_lay[JS_riv_tot]['properties'][YV_riv_id]))
-
 
 #*******************************************************************************
-#Open rrr_orb_shp
+#Read rrr_riv_shp
 #*******************************************************************************
-print('Open rrr_orb_shp')
+print('Read rrr_riv_shp')
 
-rrr_orb_lay=fiona.open(rrr_orb_shp, 'r')
-IS_orb_tot=len(rrr_orb_lay)
-print('- The number of orbit features is: '+str(IS_orb_tot))
+with rrr_swt_prf_lib.prf_stg('read_rivers'):
+     if IS_til_siz > 0:
+          YV_riv_id,IV_riv_tot_id,ZM_riv_bnd=                                  \
+                         rrr_swt_ovl_lib.riv_shp_bnds(rrr_riv_shp)
+          riv_geo=None
+     elif rrr_cch_dir != '':
+          YV_riv_id,IV_riv_tot_id,riv_geo=                                     \
+                         rrr_swt_ovl_lib.riv_shp_read_cch(rrr_riv_shp,rrr_cch_dir)
+     else:
+          YV_riv_id,IV_riv_tot_id,riv_geo=rrr_swt_ovl_lib.riv_shp_read(rrr_riv_shp)
+IS_riv_tot=len(IV_riv_tot_id)
+rrr_swt_prf_lib.prf_cnt('read_rivers', 'rows', IS_riv_tot)
+print('- The number of river features is: '+str(IS_riv_tot))
 
 
 #*******************************************************************************
-#Create spatial index for the bounds of each river feature
+#Read rrr_orb_shp
 #*******************************************************************************
-print('Create spatial index for the bounds of each river feature')
+print('Read rrr_orb_shp')
 
-index=rtree.index.Index()
-for rrr_riv_feat in rrr_riv_lay:
-     riv_fid=int(rrr_riv_feat['id'])
-     #the first argument of index.insert has to be 'int', not 'long' or 'str'
-     riv_geom=shapely.geometry.shape(rrr_riv_feat['geometry'])
-     index.insert(riv_fid, riv_geom.bounds)
+with rrr_swt_prf_lib.prf_stg('read_orbits'):
+     if IS_til_siz > 0:
+          ZV_orb_tim,ZM_orb_bnd=rrr_swt_ovl_lib.orb_shp_bnds(rrr_orb_shp)
+          orb_geo=None
+     else:
+          ZV_orb_tim,orb_geo=rrr_swt_ovl_lib.orb_shp_read(rrr_orb_shp)
+IS_orb_tot=len(ZV_orb_tim)
+rrr_swt_prf_lib.prf_cnt('read_orbits', 'rows', IS_orb_tot)
+print('- The number of orbit features is: '+str(IS_orb_tot))
 
 
 #*******************************************************************************
@@ -119,106 +147,106 @@ for rrr_riv_feat in rrr_riv_lay:
 #*******************************************************************************
 print('Find intersections')
 
-IS_ovl_cnt=0
+with rrr_swt_prf_lib.prf_stg('overlay'):
+     if IS_til_siz > 0:
+          IV_ovl_orb,IV_ovl_riv,IV_cnd_cnt,IV_tst_cnt=                         \
+                         rrr_swt_ovl_lib.ovl_riv_orb_til(rrr_riv_shp,          \
+                                         rrr_orb_shp, ZM_riv_bnd, ZM_orb_bnd,  \
+                                         IS_til_siz, rrr_ovl_csv, IS_wrk)
+     elif BS_inc:
+          IV_ovl_orb,IV_ovl_riv,IV_cnd_cnt,IV_tst_cnt=                         \
+                         rrr_swt_ovl_lib.ovl_riv_orb_inc(riv_geo, orb_geo,     \
+                                                         rrr_ovl_sta, IS_wrk)
+     else:
+          IV_ovl_orb,IV_ovl_riv,IV_cnd_cnt,IV_tst_cnt=                         \
+                         rrr_swt_ovl_lib.ovl_riv_orb_par(riv_geo, orb_geo,     \
+                                                         IS_wrk)
+
+IS_ovl_cnt=len(IV_ovl_riv)
 #The total count of river features completely contained in orbit features
-
-IM_ovl_cnt={}  # create empty dictionary for hash table
-IM_ovl_tim={}
-for JS_riv_tot in range(IS_riv_tot):
-    
-     #A hash table associating each river reach ID with the number of overlays
-     IM_ovl_cnt[IV_riv_tot_id[JS_riv_tot]]=0
-
-     #A hash table associating each river reach ID with the overlay times 
-     IM_ovl_tim[IV_riv_tot_id[JS_riv_tot]]=[]
-     
-# loop through swot orbits
-for rrr_orb_feat in rrr_orb_lay:
-     orb_fid=int(rrr_orb_feat['id'])
-     orb_shy=shapely.geometry.shape(rrr_orb_feat['geometry'])
-     for riv_fid in [int(x) for x in list(index.intersection(orb_shy.bounds))]:
-          #---------------------------------------------------------------------
-          #print('The bounds of riv_fid='+str(riv_fid)+                        \
-          #      ' intersect with the bounds of orb_fid='+str(orb_fid))
-          #---------------------------------------------------------------------
-          rrr_riv_feat=rrr_riv_lay[riv_fid]
-          riv_shy=shapely.geometry.shape(rrr_riv_feat['geometry'])
-          if orb_shy.contains(riv_shy):
-               #----------------------------------------------------------------
-               #print('riv_fid='+str(riv_fid)+                                 \
-               #      ' is completely inside of orb_fid='+str(orb_fid))
-               #----------------------------------------------------------------
-               #out_shy=riv_shy.intersection(orb_shy)    # EF: out_shy variable is not used anywhere.
-               IS_ovl_cnt = IS_ovl_cnt+1
-               IS_riv_id = int(rrr_riv_feat['properties'][YV_riv_id])
-               ZS_orb_tim=float(rrr_orb_feat['properties']['Mean_time'])
-               #IM_ovl_cnt[IS_riv_id]=IM_ovl_cnt[IS_riv_id]+1
-               IM_ovl_tim[IS_riv_id].append(ZS_orb_tim)
+rrr_swt_prf_lib.prf_cnt('overlay', 'rows', IS_orb_tot)
+rrr_swt_prf_lib.prf_cnt('overlay', 'containments', IS_ovl_cnt)
+
+#The candidates and exact tests are those of the pairs of features that were
+#actually tested, i.e. only those of the changed features in incremental mode
+rrr_swt_prf_lib.prf_cnt('overlay', 'candidates', int(IV_cnd_cnt.sum()))
+rrr_swt_prf_lib.prf_cnt('overlay', 'exact_tests', int(IV_tst_cnt.sum()))
+rrr_swt_prf_lib.prf_cnt('overlay', 'candidates_per_containment',              \
+                        float(IV_cnd_cnt.sum())/max(IS_ovl_cnt, 1))
+if IS_til_siz == 0:
+     rrr_swt_prf_lib.prf_cnt('overlay', 'orbits_outside_network', IS_orb_tot   \
+                             -len(rrr_swt_ovl_lib.ovl_orb_net(riv_geo, orb_geo)))
+if IS_orb_tot > 0:
+     ZV_cnd_rat=IV_cnd_cnt/np.maximum(np.bincount(IV_ovl_orb,                  \
+                                                  minlength=IS_orb_tot), 1)
+     rrr_swt_prf_lib.prf_cnt('overlay', 'worst_orbit_feature',                 \
+                             int(np.argmax(ZV_cnd_rat)))
+     rrr_swt_prf_lib.prf_cnt('overlay', 'worst_orbit_candidates_per_'          \
+                             +'containment', float(ZV_cnd_rat.max()))
+
+IV_ovl_cnt=np.bincount(IV_ovl_riv, minlength=IS_riv_tot)
+#The number of overlays of each river feature
+
+IV_csr_id,IV_csr_off,ZV_csr_tim,IV_csr_orb=rrr_swt_ovl_lib.ovl_csr(            \
+                               IV_riv_tot_id, IV_ovl_riv, IV_ovl_orb, ZV_orb_tim)
+#The overlay times and orbit features of each river reach ID, in compressed
+#sparse row format: those of IV_csr_id[i] are at IV_csr_off[i]:IV_csr_off[i+1]
 
 print('- The number of river features completely contained in orbit features ' \
       +'is: '+str(IS_ovl_cnt))
 
 
 #*******************************************************************************
-#Create rrr_ovl_shp based on rrr_riv_shp and rrr_orb_shp
+#Create rrr_ovl_shp based on rrr_riv_shp and the overlays
 #*******************************************************************************
-print('Create rrr_ovl_shp based on rrr_riv_shp and rrr_orb_shp')
-
-rrr_riv_crs=rrr_riv_lay.crs
-rrr_ovl_crs=rrr_riv_crs.copy()
-#print(rrr_ovl_crs)
-print('- Coordinate Reference System copied')
-
-rrr_riv_sch=rrr_riv_lay.schema
-rrr_orb_sch=rrr_orb_lay.schema
-rrr_ovl_sch=rrr_riv_sch.copy()
-rrr_ovl_sch['properties']['OVERLAYS']='int:9'
-#print(rrr_ovl_sch)
-print('- Schema copied')
+print('Create rrr_ovl_shp based on rrr_riv_shp and the overlays')
 
-rrr_ovl_lay=fiona.open(rrr_ovl_shp, 'w',                                       \
-                       crs=rrr_ovl_crs,                                        \
-                       driver='ESRI Shapefile',                                \
-                       schema=rrr_ovl_sch                                      \
-                       )
-print('- New shapefile created')
+if BS_pas:
+     ZV_ovl_fst,ZV_ovl_lst=rrr_swt_ovl_lib.ovl_fst_lst(IV_ovl_riv,             \
+                                                ZV_orb_tim[IV_ovl_orb], IS_riv_tot)
+else:
+     ZV_ovl_fst=None
+     ZV_ovl_lst=None
 
-for JS_riv_tot in range(IS_riv_tot):
-     rrr_riv_feat=rrr_riv_lay[JS_riv_tot]
-     rrr_ovl_prp=rrr_riv_feat['properties']
-     rrr_ovl_prp['OVERLAYS']=IM_ovl_cnt[IV_riv_tot_id[JS_riv_tot]]
-     rrr_ovl_geom=rrr_riv_feat['geometry']
-     rrr_ovl_lay.write({                                                       \
-                        'properties': rrr_ovl_prp,                             \
-                        'geometry': rrr_ovl_geom,                              \
-                        })
+with rrr_swt_prf_lib.prf_stg('write_shapefile'):
+     rrr_swt_ovl_lib.ovl_shp_write(rrr_riv_shp, rrr_ovl_shp, IV_ovl_cnt,       \
+                                   ZV_ovl_fst, ZV_ovl_lst)
+rrr_swt_prf_lib.prf_cnt('write_shapefile', 'rows', IS_riv_tot)
 print('- New shapefile populated')
 
-rrr_ovl_lay.close()
-print('- Closing rrr_ovl_shp so that values are saved')
-
 
 #*******************************************************************************
 #Write outputs
 #*******************************************************************************
 print('Writing rrr_ovl_csv')
 
-with open(rrr_ovl_csv, 'wb') as csvfile:
-     csvwriter = csv.writer(csvfile, dialect='excel')
-
-     # write header row to file
-     fieldnames = ['IS_riv_id', 'IM_ovl_tim']
-     writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-     writer.writeheader()
-     
-     for JS_riv_tot in range(IS_riv_tot):
-          IS_riv_id = IV_riv_tot_id[JS_riv_tot]
-          #IV_line = [IS_riv_id, IM_ovl_cnt[IS_riv_id]] 
-
-          for riv_times in IM_ovl_tim[IS_riv_id]:
-              IV_line = [IS_riv_id, riv_times]
-              
-              csvwriter.writerow(IV_line) 
+IV_out_id,ZV_out_tim=rrr_swt_ovl_lib.csr_flat(IV_csr_id, IV_csr_off, ZV_csr_tim)
+
+with rrr_swt_prf_lib.prf_stg('write_overlays'):
+     if YS_fmt == 'csv':
+          with open(rrr_ovl_csv, 'w', newline='') as csvfile:
+               csvwriter = csv.writer(csvfile, dialect='excel')
+
+               # write header row to file
+               fieldnames = ['IS_riv_id', 'IM_ovl_tim']
+               writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+               writer.writeheader()
+
+               csvwriter.writerows(zip(IV_out_id.tolist(), ZV_out_tim.tolist()))
+     else:
+          rrr_swt_out_lib.out_write(rrr_ovl_csv, YS_fmt,                       \
+                                    pd.DataFrame({'IS_riv_id': IV_out_id,      \
+                                                  'IM_ovl_tim': ZV_out_tim}),  \
+                                    True)
+rrr_swt_prf_lib.prf_cnt('write_overlays', 'rows', len(IV_out_id))
+
+
+#*******************************************************************************
+#Write report
+#*******************************************************************************
+if rrr_prf_out != '' or rrr_pro_dir != '':
+     print('Writing report')
+     rrr_swt_prf_lib.prf_write(rrr_prf_out)
 
 
 #*******************************************************************************